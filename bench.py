@@ -0,0 +1,446 @@
+"""
+MicroMDM 管理工具效能測試
+
+啟動一個本機假 MicroMDM（/v1/devices、/v1/commands、/push、VPP 與 webhook 事件發送），
+以合成裝置跑 main.py 的批次流程，回報吞吐量、p50/p99 延遲與記憶體峰值。
+
+用法：
+    python bench.py --sizes 100,1000,10000 --latency-ms 5 --error-rate 0.01
+    python bench.py --sizes 100 --output bench.json --baseline bench_baseline.json
+    python bench.py --sizes 100 --paths devices --import-repeat 10   # 同時追蹤 main.py 匯入時間
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import random
+import plistlib
+import argparse
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import logging
+import queue
+import sys
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+import main as mdm
+
+BENCH_API_KEY = 'bench-api-key'
+BENCH_ADAM_ID = '1234567890'
+BENCH_PATHS = ['devices', 'lock', 'vpp_install', 'profile_install']
+
+
+def synthetic_devices(device_count):
+    """合成裝置清單；假伺服器行程與量測端各自產生，內容相同"""
+    return [
+        {
+            "udid": f"BENCH-{i:08d}-{uuid.uuid5(uuid.NAMESPACE_OID, str(i)).hex[:16].upper()}",
+            "serial_number": f"SN{i:010d}",
+            "model": "iPad13,18" if i % 2 else "iPhone15,2",
+            "os_version": "17.5.1" if i % 3 else "16.7.8",
+            "enrollment_status": True,
+            "last_seen": datetime.now(timezone.utc).isoformat(),
+        }
+        for i in range(device_count)
+    ]
+
+
+def create_fake_mdm(device_count, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, webhook_url=None):
+    """建立假 MicroMDM Flask app，行為比照 test.py 的寫法"""
+    app = Flask(__name__)
+    state = {
+        'devices': synthetic_devices(device_count),
+        'queues': {},
+        'licenses': {},
+        'lock': threading.Lock(),
+    }
+    emitter = WebhookEmitter(webhook_url, latency_ms=latency_ms) if webhook_url else None
+    app.config['state'] = state
+    app.config['emitter'] = emitter
+
+    @app.before_request
+    def inject_latency_and_errors():
+        delay = latency_ms + random.uniform(0, jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if error_rate and random.random() < error_rate:
+            return jsonify({"error": "injected failure"}), 500
+        if request.path.startswith('/vpp/'):
+            return None
+        if request.authorization is None or request.authorization.password != BENCH_API_KEY:
+            return '', 401
+
+    @app.route('/v1/devices', methods=['POST'])
+    def list_devices():
+        return jsonify({"devices": state['devices']})
+
+    @app.route('/v1/devices/<udid>', methods=['GET'])
+    def get_device(udid):
+        for device in state['devices']:
+            if device['udid'] == udid:
+                return jsonify(device)
+        return '', 404
+
+    @app.route('/v1/commands', methods=['POST'])
+    def enqueue_command():
+        body = request.get_json(force=True)
+        command_uuid = str(uuid.uuid4())
+        request_type = body.get('request_type', '')
+        plist = plistlib.dumps({"CommandUUID": command_uuid, "Command": {"RequestType": request_type}})
+        entry = {
+            "uuid": command_uuid,
+            "payload": base64.b64encode(plist).decode(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "times_sent": 0,
+        }
+        with state['lock']:
+            state['queues'].setdefault(body.get('udid'), []).append(entry)
+        if emitter:
+            emitter.emit(body.get('udid'), command_uuid, request_type)
+        return jsonify({"payload": {"command_uuid": command_uuid, "command": {"request_type": request_type}}}), 201
+
+    @app.route('/v1/commands/<udid>', methods=['GET', 'DELETE'])
+    def command_queue(udid):
+        with state['lock']:
+            if request.method == 'DELETE':
+                state['queues'].pop(udid, None)
+                return '', 200
+            return jsonify({"commands": list(state['queues'].get(udid, []))})
+
+    @app.route('/push/<udid>', methods=['GET'])
+    def push(udid):
+        return jsonify({"status": "success", "push_notification_id": str(uuid.uuid4())})
+
+    @app.route('/v1/dep/syncnow', methods=['POST'])
+    def dep_sync():
+        return '', 200
+
+    @app.route('/vpp/manageVPPLicensesByAdamIdSrv', methods=['POST'])
+    def vpp_manage():
+        body = request.get_json(force=True)
+        serials = body.get('associateSerialNumbers', [])
+        with state['lock']:
+            for serial in serials:
+                state['licenses'].setdefault(str(body.get('adamIdStr')), set()).add(serial)
+        return jsonify({
+            "status": 0,
+            "adamIdStr": body.get('adamIdStr'),
+            "associations": [{"serialNumber": s} for s in serials],
+        })
+
+    @app.route('/vpp/getVPPLicensesSrv', methods=['POST'])
+    def vpp_licenses():
+        body = request.get_json(force=True)
+        with state['lock']:
+            serials = sorted(state['licenses'].get(str(body.get('adamId')), set()))
+        start = int(body.get('batchToken') or 0)
+        page = serials[start:start + 100]
+        result = {
+            "status": 0,
+            "licenses": [{"serialNumber": s, "adamIdStr": body.get('adamId'), "status": "Associated"} for s in page],
+        }
+        if start + 100 < len(serials):
+            result["batchToken"] = str(start + 100)
+        else:
+            result["sinceModifiedToken"] = str(len(serials))
+        return jsonify(result)
+
+    return app
+
+
+class WebhookEmitter:
+    """把每個排入佇列的命令轉成 MicroMDM acknowledge_event 送到 webhook"""
+
+    def __init__(self, webhook_url, latency_ms=0.0):
+        self.webhook_url = webhook_url
+        self.latency_ms = latency_ms
+        self.events = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def emit(self, udid, command_uuid, request_type):
+        self.events.put((udid, command_uuid, request_type))
+
+    def _run(self):
+        while True:
+            udid, command_uuid, request_type = self.events.get()
+            if self.latency_ms:
+                time.sleep(self.latency_ms / 1000)
+            raw = plistlib.dumps({"CommandUUID": command_uuid, "Status": "Acknowledged", "UDID": udid})
+            event = {
+                "topic": "mdm.Connect",
+                "event_id": str(uuid.uuid4()),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "acknowledge_event": {
+                    "udid": udid,
+                    "status": "Acknowledged",
+                    "command_uuid": command_uuid,
+                    "raw_payload": base64.b64encode(raw).decode(),
+                },
+            }
+            try:
+                self.session.post(self.webhook_url, json=event, timeout=5)
+                self.sent += 1
+            except requests.RequestException:
+                self.failed += 1
+
+
+class FakeMDMServer:
+    """
+    在獨立行程啟動假 MicroMDM（python bench.py --serve），port 0 表示自動選擇。
+    伺服器不與量測端共用 GIL 與記憶體，吞吐量與 tracemalloc 峰值只反映 main.py 這一側。
+    """
+
+    def __init__(self, device_count, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, webhook_url=None, seed=0,
+                 host='127.0.0.1', port=0):
+        self.args = [
+            sys.executable, os.path.abspath(__file__), '--serve', '--host', host, '--port', str(port),
+            '--devices', str(device_count), '--latency-ms', str(latency_ms), '--jitter-ms', str(jitter_ms),
+            '--error-rate', str(error_rate), '--seed', str(seed),
+        ]
+        if webhook_url:
+            self.args += ['--webhook-url', webhook_url]
+        self.proc = None
+        self.url = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.args, stdout=subprocess.PIPE, text=True)
+        # 子行程開始監聽後會先印出自己的 URL
+        self.url = self.proc.stdout.readline().strip()
+        if not self.url:
+            self.proc.wait()
+            raise RuntimeError(f"假 MicroMDM 啟動失敗（exit {self.proc.returncode}）")
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(timeout=10)
+
+
+def serve_fake_mdm(args):
+    """--serve：在目前行程執行假 MicroMDM，直到被終止"""
+    random.seed(args.seed)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = create_fake_mdm(args.devices, args.latency_ms, args.jitter_ms, args.error_rate, args.webhook_url)
+    server = make_server(args.host, args.port, app, threaded=True)
+    print(f"http://{args.host}:{server.server_port}", flush=True)
+    server.serve_forever()
+
+
+def run_path(path, devices, workdir):
+    """以與選單相同的 dispatch_to_devices 並行執行單一批次流程，回傳每台裝置延遲（秒）與錯誤數"""
+    latencies = []
+
+    if path == 'devices':
+        start = time.perf_counter()
+        rows = mdm.get_inventory(os.path.join(workdir, 'devices.csv'))
+        latencies.append(time.perf_counter() - start)
+        return latencies, 0 if rows is not None else 1
+
+    profile_path = os.path.join(workdir, 'bench.mobileconfig')
+    if path == 'profile_install' and not os.path.exists(profile_path):
+        with open(profile_path, 'wb') as f:
+            f.write(plistlib.dumps({"PayloadIdentifier": "bench.profile", "PayloadContent": ["x" * 2048]}))
+
+    # 與 run_action 的選項 3（鎖定）、1（VPP 安裝）、安裝描述檔相同的送出函式
+    if path == 'lock':
+        def send(udid, serial):
+            return mdm.lock_device(mdm.MDM_URL, mdm.API_KEY, udid, "123456")
+    elif path == 'vpp_install':
+        def send(udid, serial):
+            mdm.assign_vpp_license("bench-stoken", BENCH_ADAM_ID, serial)
+            return mdm.install_app_to_device(mdm.MDM_URL, mdm.API_KEY, udid, BENCH_ADAM_ID)
+    elif path == 'profile_install':
+        def send(udid, serial):
+            return mdm.install_profile(mdm.MDM_URL, mdm.API_KEY, udid, profile_path)
+    else:
+        raise ValueError(f"未知的流程：{path}")
+
+    def timed(udid, serial):
+        start = time.perf_counter()
+        try:
+            return send(udid, serial)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    failed = mdm.dispatch_to_devices(devices, timed)
+    return latencies, len(failed)
+
+
+def measure_import_time(repeat=5, module='main'):
+    """以 python -X importtime 量測 main.py 的匯入時間（每次都是全新的直譯器）"""
+    samples = []
+    slowest = {}
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+        )
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            parts = [p.strip() for p in line[len('import time:'):].split('|')]
+            if not parts[0].isdigit():
+                continue
+            self_us, cumulative_us, name = int(parts[0]), int(parts[1]), parts[2]
+            if name == module:
+                samples.append(cumulative_us / 1_000_000)
+            slowest[name.strip()] = max(slowest.get(name.strip(), 0), self_us)
+    top = sorted(slowest.items(), key=lambda item: -item[1])[:5]
+    return {
+        "path": "import",
+        "devices": 0,
+        "elapsed_s": round(sum(samples), 4),
+        "throughput_dev_s": 0.0,
+        "p50_ms": round(mdm.percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(mdm.percentile(samples, 99) * 1000, 3),
+        "errors": repeat - len(samples),
+        "peak_mem_kb": 0.0,
+        "slowest_modules": [{"module": name, "self_ms": round(us / 1000, 3)} for name, us in top],
+    }
+
+
+def run_benchmark(sizes, paths, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, webhook_url=None, seed=0):
+    results = []
+    saved = (mdm.console.quiet, mdm.MDM_URL, mdm.API_KEY, mdm.VPP_SERVICE_URL, mdm.mdm_servers,
+             [store.path for store in mdm.PERSISTENT_STORES])
+    mdm.console.quiet = True
+    # 本機快取寫到暫存目錄，避免污染工作目錄
+    store_dir = tempfile.mkdtemp(prefix='mdm-bench-')
+    try:
+        for store in mdm.PERSISTENT_STORES:
+            store.path = os.path.join(store_dir, os.path.basename(store.path))
+        for size in sizes:
+            devices = [(d['udid'], d['serial_number']) for d in synthetic_devices(size)]
+            with FakeMDMServer(size, latency_ms, jitter_ms, error_rate, webhook_url, seed) as server, \
+                    tempfile.TemporaryDirectory() as workdir:
+                mdm.MDM_URL, mdm.API_KEY = server.url, BENCH_API_KEY
+                mdm.VPP_SERVICE_URL = f"{server.url}/vpp"
+                # 與 CLI 相同，裝置清單經由 get_inventory 向設定的伺服器取得
+                mdm.mdm_servers = [mdm.MdmServer("bench", server.url, BENCH_API_KEY)]
+                for path in paths:
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    latencies, errors = run_path(path, devices, workdir)
+                    elapsed = time.perf_counter() - start
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    results.append({
+                        "path": path,
+                        "devices": size,
+                        "elapsed_s": round(elapsed, 4),
+                        "throughput_dev_s": round(size / elapsed, 2) if elapsed else 0.0,
+                        "p50_ms": round(mdm.percentile(latencies, 50) * 1000, 3),
+                        "p99_ms": round(mdm.percentile(latencies, 99) * 1000, 3),
+                        "errors": errors,
+                        "peak_mem_kb": round(peak / 1024, 1),
+                    })
+    finally:
+        mdm.console.quiet, mdm.MDM_URL, mdm.API_KEY, mdm.VPP_SERVICE_URL, mdm.mdm_servers, store_paths = saved
+        for store, path in zip(mdm.PERSISTENT_STORES, store_paths):
+            store.path = path
+        shutil.rmtree(store_dir, ignore_errors=True)
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """吞吐量低於基準 (1 - tolerance)，或匯入時間高於基準 (1 + tolerance) 視為效能退步"""
+    base = {(r['path'], r['devices']): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r['path'], r['devices']))
+        if not b:
+            continue
+        if r['path'] == 'import':
+            if r['p50_ms'] > b['p50_ms'] * (1 + tolerance):
+                regressions.append((r, b))
+        elif r['throughput_dev_s'] < b['throughput_dev_s'] * (1 - tolerance):
+            regressions.append((r, b))
+    return regressions
+
+
+def print_results(results):
+    table = mdm.Table(title="📈 效能測試結果")
+    for column in ["流程", "裝置數", "耗時(s)", "吞吐量(台/s)", "p50(ms)", "p99(ms)", "錯誤", "記憶體峰值(KB)"]:
+        table.add_column(column, justify="right" if column != "流程" else "left")
+    for r in results:
+        table.add_row(
+            r['path'], str(r['devices']), f"{r['elapsed_s']:.2f}", f"{r['throughput_dev_s']:.1f}",
+            f"{r['p50_ms']:.2f}", f"{r['p99_ms']:.2f}", str(r['errors']), f"{r['peak_mem_kb']:.0f}",
+        )
+    mdm.console.print(table)
+
+    for r in results:
+        if r.get('slowest_modules'):
+            slowest = ', '.join(f"{m['module']} {m['self_ms']:.1f}ms" for m in r['slowest_modules'])
+            mdm.console.print(f"🐢 匯入最慢的模組：{slowest}", style="yellow")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MicroMDM 管理工具效能測試")
+    parser.add_argument('--sizes', default='100,1000', help="合成裝置數量，逗號分隔（例如 100,1000,50000）")
+    parser.add_argument('--paths', default=','.join(BENCH_PATHS), help=f"要執行的流程：{','.join(BENCH_PATHS)}")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="每個請求注入的延遲")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="延遲的隨機抖動上限")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="回應 500 的機率 (0~1)")
+    parser.add_argument('--webhook-url', help="把 acknowledge_event 送到此 webhook（例如 test.py）")
+    parser.add_argument('--output', help="將結果寫成 JSON")
+    parser.add_argument('--baseline', help="與先前輸出的 JSON 比較吞吐量")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="允許的吞吐量下降比例")
+    parser.add_argument('--import-repeat', type=int, default=5, help="量測 main.py 匯入時間的次數（0 表示略過）")
+    parser.add_argument('--seed', type=int, default=0)
+    # 由 FakeMDMServer 啟動子行程時使用
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--host', default='127.0.0.1', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--devices', type=int, default=0, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.serve:
+        serve_fake_mdm(args)
+        raise SystemExit(0)
+    random.seed(args.seed)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    paths = [p.strip() for p in args.paths.split(',') if p.strip()]
+    unknown = set(paths) - set(BENCH_PATHS)
+    if unknown:
+        raise SystemExit(f"未知的流程：{', '.join(sorted(unknown))}")
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    results = run_benchmark(sizes, paths, args.latency_ms, args.jitter_ms, args.error_rate, args.webhook_url,
+                            args.seed)
+    if args.import_repeat:
+        results.insert(0, measure_import_time(args.import_repeat))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for r, b in regressions:
+            if r['path'] == 'import':
+                detail = f"匯入時間 {b['p50_ms']:.1f} → {r['p50_ms']:.1f} ms"
+            else:
+                detail = f"({r['devices']} 台) {b['throughput_dev_s']:.1f} → {r['throughput_dev_s']:.1f} 台/s"
+            mdm.console.print(f"❌ 效能退步：{r['path']} {detail}", style="bold red")
+        if regressions:
+            raise SystemExit(1)
+        mdm.console.print("✅ 未發現效能退步", style="bold green")
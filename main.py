@@ -1,59 +1,277 @@
 import os
 import csv
 import base64
-import requests
-import subprocess
+import importlib
 from dotenv import load_dotenv
-from rich.table import Table
-from rich.console import Console
-from rich.prompt import Prompt, Confirm
 import time
 import threading
+import argparse
+from contextlib import contextmanager
 
 import json
-import socketio
+import atexit
+import functools
+import plistlib
+import hashlib
+import struct
+import re
+import bisect
+import mmap
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+
+class LazyModule:
+    """第一次存取屬性時才 import 模組，縮短 CLI 啟動時間"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class LazyObject:
+    """第一次使用時才建立物件（例如 rich 的 Console、Table、Prompt）"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr.startswith('_'):
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._resolve(), attr, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+requests = LazyModule('requests')
+socketio = LazyModule('socketio')
+subprocess = LazyModule('subprocess')
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+tracemalloc = LazyModule('tracemalloc')
+zlib = LazyModule('zlib')
+multiprocessing = LazyModule('multiprocessing')
+shared_memory = LazyModule('multiprocessing.shared_memory')
+Table = LazyObject(lambda: importlib.import_module('rich.table').Table)
+Prompt = LazyObject(lambda: importlib.import_module('rich.prompt').Prompt)
+Confirm = LazyObject(lambda: importlib.import_module('rich.prompt').Confirm)
+
 # 載入 .env 檔案
 load_dotenv()
 
 # 設定常數
 VPPTOKEN_PATH = 'ISHA_APP_token.vpptoken'
+VPP_SERVICE_URL = os.getenv('VPP_SERVICE_URL', 'https://vpp.itunes.apple.com/mdm')
 
 API_KEY = os.getenv('API_KEY')
 MDM_URL = os.getenv('MDM_URL')
+# 多台 MicroMDM：JSON 陣列 [{"name", "url", "api_key", "max_workers", "rate_limit"}]，未設定時只使用 MDM_URL / API_KEY
+MDM_SERVERS_FILE = os.getenv('MDM_SERVERS_FILE', '')
 WEBSOCKET_URL = os.getenv('WEBSOCKET_URL')
 DEVICE_LIST_CSV = './devices.csv'
-MDMCTL_BIN = 'mdmctl'
+MDMCTL_BIN = os.getenv('MDMCTL_BIN', 'mdmctl')
+MDMCTL_TIMEOUT = int(os.getenv('MDMCTL_TIMEOUT', '60'))
+MDMCTL_MAX_PROCS = int(os.getenv('MDMCTL_MAX_PROCS', '4'))
 PROFILES_DIR = './profiles'
+PROFILE_DIR = os.getenv('PROFILE_DIR', './profile_output')
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '20'))
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '16'))
+# 每個執行緒池排隊中工作數的上限倍數（相對於執行緒數），避免大量參數列一次讀進記憶體
+IN_FLIGHT_FACTOR = 2
+DEVICE_FACTS_PATH = os.getenv('DEVICE_FACTS_PATH', './device_facts.json')
+DEVICE_INFO_QUERIES = ["UDID", "DeviceName", "OSVersion", "ModelName", "ProductName"]
+INSTALLED_APPS_PATH = os.getenv('INSTALLED_APPS_PATH', './installed_apps.json')
+ITUNES_LOOKUP_URL = os.getenv('ITUNES_LOOKUP_URL', 'https://itunes.apple.com/lookup')
+VPP_LICENSES_PATH = os.getenv('VPP_LICENSES_PATH', './vpp_licenses.json')
+LOST_MODE_PATH = os.getenv('LOST_MODE_PATH', './lost_mode.json')
+DEVICE_LOCATIONS_PATH = os.getenv('DEVICE_LOCATIONS_PATH', './device_locations.jsonl')
+OS_UPDATE_CAMPAIGN_PATH = os.getenv('OS_UPDATE_CAMPAIGN_PATH', './os_update_campaign.json')
+DEVICE_SNAPSHOT_PATH = os.getenv('DEVICE_SNAPSHOT_PATH', './device_snapshot.json')
+DEVICE_GROUPS_PATH = os.getenv('DEVICE_GROUPS_PATH', './device_groups.json')
+RESULTS_DIR = os.getenv('RESULTS_DIR', './results')
+DEVICE_PAGE_SIZE = int(os.getenv('DEVICE_PAGE_SIZE', '25'))
+# 要求 relay 轉送的事件種類（逗號分隔），checkin_event 量大，預設不訂閱
+EVENT_KINDS = os.getenv('EVENT_KINDS', 'acknowledge_event')
+EVENT_CURSOR_PATH = os.getenv('EVENT_CURSOR_PATH', './event_cursor.json')
+# 判斷重複事件時保留最近幾個已處理的序號
+EVENT_CURSOR_WINDOW = int(os.getenv('EVENT_CURSOR_WINDOW', '4096'))
+# 向 relay 要求批次二進位事件（mdm_event_batch），relay 不支援時仍會送一般的 mdm_event
+EVENT_BATCHING = os.getenv('EVENT_BATCHING', '1') == '1'
+METRICS_PATH = os.getenv('METRICS_PATH', './metrics.json')
+ACK_LATENCY_WINDOW = int(os.getenv('ACK_LATENCY_WINDOW', '1000'))
+# 超過多久沒有 check-in / ack 視為離線（小時）
+OFFLINE_AFTER_HOURS = float(os.getenv('OFFLINE_AFTER_HOURS', '168'))
+DEFERRED_COMMANDS_PATH = os.getenv('DEFERRED_COMMANDS_PATH', './deferred_commands.json')
+# 超過此大小（bytes）的 raw_payload 交給子行程解析，PAYLOAD_PARSE_WORKERS=0 表示停用
+PAYLOAD_PARSE_THRESHOLD = int(os.getenv('PAYLOAD_PARSE_THRESHOLD', str(256 * 1024)))
+PAYLOAD_PARSE_WORKERS = int(os.getenv('PAYLOAD_PARSE_WORKERS', '2'))
+# test.py 保存 webhook event 的 JSONL 分段目錄，每個分段旁邊會建立 .idx.json 索引
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR', './event_logs')
+EVENT_LOG_TIME_STRIDE = 1000  # 每幾筆記錄一個時間索引點
+# 每台裝置每種回應類型在索引中保留的最近筆數，更舊的紀錄查詢時直接搜尋檔案
+EVENT_LOG_RECENT_PER_KEY = int(os.getenv('EVENT_LOG_RECENT_PER_KEY', '16'))
+EVENT_LOG_CACHED_SEGMENTS = 4  # 同時留在記憶體的分段索引數
+RESULT_FORMAT = os.getenv('RESULT_FORMAT', 'jsonl')  # jsonl 或 csv
+# DEP 新裝置出現時自動執行的命令，例如 "DeviceInformation,InstallProfile=./profiles/wifi.mobileconfig"
+DEP_ONBOARDING_COMMANDS = os.getenv('DEP_ONBOARDING_COMMANDS', '')
+# 計算裝置快照雜湊時忽略的欄位（每次 check-in 都會變動）
+SNAPSHOT_IGNORE_FIELDS = {"last_seen"}
+
+# 裝置資訊快取的有效時間（秒），未列出的欄位使用 DEFAULT_FACT_TTL
+DEFAULT_FACT_TTL = 3600
+FACT_TTLS = {
+    "UDID": 365 * 86400,
+    "LastSeen": 365 * 86400,
+    "SerialNumber": 365 * 86400,
+    "ModelName": 30 * 86400,
+    "Model": 30 * 86400,
+    "ProductName": 30 * 86400,
+    "WiFiMAC": 30 * 86400,
+    "BluetoothMAC": 30 * 86400,
+    "DeviceName": 86400,
+    "IsSupervised": 86400,
+    "OSVersion": 6 * 3600,
+    "BuildVersion": 6 * 3600,
+    "AvailableOSUpdates": 6 * 3600,
+    "SecurityInfo": 3600,
+    "BatteryLevel": 900,
+    "IsMDMLostModeEnabled": 600,
+}
+
+console = LazyObject(lambda: importlib.import_module('rich.console').Console())
+
+# --profile 模式下的效能分析器（None 表示停用）
+profiler = None
+
+# Socket.IO 客戶端（需要時才建立，見 get_sio）
+sio = None
+socketio_thread = None
+
+# 需要接收 webhook 回應（acknowledge_event）的選單功能
+EVENT_ACTIONS = {"10", "11", "12", "13", "19", "20", "21", "26", "27", "28", "29", "30", "34"}
+# 會送出 MDM 命令、可略過或延後離線裝置的選單功能
+OFFLINE_AWARE_ACTIONS = {
+    "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19",
+    "20", "21", "26", "27", "28", "29", "30"
+}
+
+
+class EventSubscription:
+    """
+    事件訂閱條件：事件種類、命令類型、udid、command_uuid，空集合表示不限制。
+    條件會隨 auth 一起送給 relay，讓 relay 只轉送符合的事件；收到的事件在本機也會再比對一次，
+    relay 不支援訂閱時一樣能提早丟掉不需要的事件。
+    """
 
-# 確保目錄存在
-os.makedirs(PROFILES_DIR, exist_ok=True)
-
-console = Console()
+    def __init__(self, kinds=(), request_types=(), udids=(), command_uuids=(), checkin_udids=(), ack_udids=()):
+        self.lock = threading.Lock()
+        self.kinds = set(kinds)
+        self.request_types = set(request_types)
+        self.udids = set(udids)
+        self.command_uuids = set(command_uuids)
+        # 有延後命令的裝置，不論其他條件都要收到它們的 check-in
+        self.checkin_udids = set(checkin_udids)
+        # 延後命令已送出的裝置，之後的選單操作改變條件時仍要收到它們的 ack
+        self.ack_udids = set(ack_udids)
+
+    def update(self, **filters):
+        with self.lock:
+            for key, values in filters.items():
+                setattr(self, key, set(values or ()))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "kinds": sorted(self.kinds),
+                "request_types": sorted(self.request_types),
+                "udids": sorted(self.udids),
+                "command_uuids": sorted(self.command_uuids),
+                "checkin_udids": sorted(self.checkin_udids),
+                "ack_udids": sorted(self.ack_udids),
+            }
 
-# 創建 Socket.IO 客戶端
-sio = socketio.Client()
+    def matches(self, data):
+        kind = next((k for k in ("acknowledge_event", "checkin_event") if k in data), None)
+        if kind is None:
+            # server_info 等控制訊息一律保留
+            return True
+        event = data[kind] or {}
+        with self.lock:
+            if kind == "checkin_event" and event.get("udid") in self.checkin_udids:
+                return True
+            if kind == "acknowledge_event" and event.get("udid") in self.ack_udids:
+                return True
+            if self.kinds and kind not in self.kinds:
+                return False
+            if self.udids and event.get("udid") not in self.udids:
+                return False
+            if kind != "acknowledge_event":
+                return True
+            if self.command_uuids and event.get("command_uuid") not in self.command_uuids:
+                return False
+            if self.request_types:
+                sent = command_tracker.commands.get(event.get("command_uuid"))
+                return sent is not None and sent["request_type"] in self.request_types
+        return True
+
+
+event_subscription = EventSubscription(kinds=filter(None, (k.strip() for k in EVENT_KINDS.split(","))))
+
+
+def subscribe_events(**filters):
+    """更新訂閱條件；已連線時立即通知 relay"""
+    event_subscription.update(**filters)
+    if sio is not None and sio.connected:
+        sio.emit('subscribe', event_subscription.to_dict())
 
 
-@sio.event
 def connect():
     console.print("[SocketIO] 已連接到 webhook 伺服器!", style="bold green")
-    sio.emit('auth', {'api_key': API_KEY})
+    event_subscription.update(checkin_udids=deferred_commands.udids())
+    # resume_from：請 relay 從事件紀錄補送斷線期間序號大於此值的事件
+    sio.emit('auth', {
+        'api_key': API_KEY,
+        'subscribe': event_subscription.to_dict(),
+        'resume_from': event_cursor.last_seq(),
+        'epoch': event_cursor.epoch(),
+        'transport': {'batch': EVENT_BATCHING, 'compression': ['zlib'] if EVENT_BATCHING else []},
+    })
 
-@sio.on('auth_result')
 def on_auth_result(data):
     print("認證回應:", data)
+    event_cursor.check_epoch(data.get('epoch'))
     if data['status'] == 'ok':
         print("Auth success! Now ready to receive events.")
     else:
         print("Auth failed!")
 
-@sio.event
 def disconnect():
     console.print("[SocketIO] 與 webhook 伺服器斷開連接", style="bold red")
 
 
-@sio.on('mdm_event')
 def on_mdm_event(data):
+    # 補送與即時事件可能重疊，已處理過的序號直接丟掉
+    if 'seq' in data and not event_cursor.advance(data['seq']):
+        return
+    if not event_subscription.matches(data):
+        return
     # console.print("[SocketIO] 收到 MDM 事件：", style="bold green")
     # console.print(json.dumps(data, indent=2, ensure_ascii=False))
 
@@ -66,14 +284,23 @@ def on_mdm_event(data):
         if 'raw_payload' in data['acknowledge_event']:
             try:
                 raw = data['acknowledge_event']['raw_payload']
-                decoded = base64.b64decode(raw).decode(errors='ignore')
-                console.print("[SocketIO] 解碼的 raw_payload：", style="bold green")
-                console.print(decoded)
+                if payload_parser.should_offload(raw):
+                    # 大型回應（App / 憑證清單）不印出全文，交給背景解析
+                    console.print(f"[SocketIO] 收到大型 raw_payload（約 {payload_parser.size_of(raw) // 1024} KB），"
+                                  f"背景解析中", style="bold green")
+                else:
+                    decoded = raw_payload_bytes(raw).decode(errors='ignore')
+                    console.print("[SocketIO] 解碼的 raw_payload：", style="bold green")
+                    console.print(decoded)
             except Exception as e:
                 console.print(f"[SocketIO] 解碼 raw_payload 錯誤：{str(e)}", style="bold red")
 
+        handle_ack_event(data['acknowledge_event'])
+
     elif 'checkin_event' in data:
-        pass
+        udid = data['checkin_event'].get('udid')
+        if udid:
+            mark_device_seen(udid)
         # console.print("[SocketIO] Checkin 事件：", style="bold blue")
         # console.print(json.dumps(data['checkin_event'], indent=2, ensure_ascii=False))
 
@@ -85,19 +312,120 @@ def on_mdm_event(data):
         console.print(json.dumps(data, indent=2, ensure_ascii=False))
 
 
+EVENT_BATCH_MAGIC = b"MDB1"
+EVENT_BATCH_ZLIB = 0x01
+EVENT_KIND_KEYS = ("acknowledge_event", "checkin_event")
+
+
+def raw_payload_bytes(raw):
+    """raw_payload 在 JSON 事件中是 base64 字串，在批次框架中是原始 bytes"""
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        return bytes(raw)
+    return base64.b64decode(raw)
+
+
+def encode_event_batch(events, compress=False):
+    """
+    把多個事件編成一個 mdm_event_batch 框架：
+    MAGIC(4) + flags(1) + 內容（flags 含 ZLIB 時以 zlib 壓縮）；
+    內容為每個事件依序的 [header 長度(4)][header JSON][payload 長度(4)][raw_payload bytes]，
+    header 為去掉 raw_payload 的事件，payload 保持原始 bytes，不再經過 base64。
+    """
+    body = bytearray()
+    for event in events:
+        header = dict(event)
+        raw = b""
+        for kind in EVENT_KIND_KEYS:
+            if isinstance(header.get(kind), dict) and header[kind].get("raw_payload"):
+                header[kind] = dict(header[kind])
+                raw = raw_payload_bytes(header[kind].pop("raw_payload"))
+                break
+        encoded = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode()
+        body += struct.pack(">I", len(encoded)) + encoded + struct.pack(">I", len(raw)) + raw
+    flags = 0
+    if compress:
+        body = zlib.compress(bytes(body))
+        flags |= EVENT_BATCH_ZLIB
+    return EVENT_BATCH_MAGIC + bytes([flags]) + bytes(body)
+
+
+def decode_event_batch(frame):
+    """解開 mdm_event_batch 框架，產出事件 dict（raw_payload 為 bytes）；框架不完整時拋出 ValueError"""
+    if not isinstance(frame, (bytes, bytearray, memoryview)):
+        raise TypeError(f"mdm_event_batch 框架應為 bytes，收到 {type(frame).__name__}")
+    frame = bytes(frame)
+    if len(frame) < 5 or frame[:4] != EVENT_BATCH_MAGIC:
+        raise ValueError("不是 mdm_event_batch 框架")
+    body = frame[5:]
+    if frame[4] & EVENT_BATCH_ZLIB:
+        body = zlib.decompress(body)
+    view = memoryview(body)
+    offset = 0
+    while offset < len(view):
+        (header_len,) = struct.unpack_from(">I", view, offset)
+        offset += 4
+        if offset + header_len > len(view):
+            raise ValueError("mdm_event_batch 事件標頭不完整")
+        event = json.loads(bytes(view[offset:offset + header_len]))
+        offset += header_len
+        (raw_len,) = struct.unpack_from(">I", view, offset)
+        offset += 4
+        if offset + raw_len > len(view):
+            raise ValueError("mdm_event_batch 原始內容不完整")
+        if raw_len:
+            for kind in EVENT_KIND_KEYS:
+                if isinstance(event.get(kind), dict):
+                    event[kind]["raw_payload"] = bytes(view[offset:offset + raw_len])
+                    break
+        offset += raw_len
+        yield event
+
+
+def on_mdm_event_batch(frame):
+    try:
+        events = list(decode_event_batch(frame))
+    except (ValueError, TypeError, IndexError, struct.error, zlib.error) as e:
+        console.print(f"[SocketIO] 無法解析批次事件：{e}", style="bold red")
+        return
+    for event in events:
+        on_mdm_event(event)
+
+
+def get_sio():
+    """建立 Socket.IO 客戶端並註冊事件處理函式（只建立一次）"""
+    global sio
+    if sio is None:
+        sio = socketio.Client()
+        sio.on('connect', connect)
+        sio.on('auth_result', on_auth_result)
+        sio.on('disconnect', disconnect)
+        sio.on('mdm_event', on_mdm_event)
+        sio.on('mdm_event_batch', on_mdm_event_batch)
+    return sio
+
+
 def start_socketio_client():
+    """啟動 Socket.IO 監聽執行緒；已在執行中則直接回傳"""
+    global socketio_thread
+    if socketio_thread is not None and socketio_thread.is_alive():
+        return socketio_thread
+
     # 從環境變數或配置獲取 webhook 伺服器地址
     ws_host = os.getenv('WEBHOOK_HOST', WEBSOCKET_URL)
     ws_port = os.getenv('WEBHOOK_PORT', '443')
+    if not ws_host:
+        console.print("⚠️ 未設定 WEBSOCKET_URL，無法接收裝置回應", style="bold yellow")
+        return None
     socketio_url = f"https://{ws_host}:{ws_port}"
 
     console.print(f"[SocketIO] 正在連接到 webhook 伺服器 {socketio_url}", style="bold blue")
+    client = get_sio()
 
     def run_client():
         while True:
             try:
-                if not sio.connected:
-                    sio.connect(socketio_url)
+                if not client.connected:
+                    client.connect(socketio_url)
                     console.print("[SocketIO] 連接成功", style="bold green")
                 time.sleep(1)  # 定期檢查連接狀態
             except Exception as e:
@@ -106,52 +434,1815 @@ def start_socketio_client():
                 time.sleep(5)
 
     # 在單獨的線程中啟動 Socket.IO 客戶端
-    thread = threading.Thread(target=run_client, daemon=True)
-    thread.start()
-    return thread
+    socketio_thread = threading.Thread(target=run_client, daemon=True)
+    socketio_thread.start()
+    return socketio_thread
 
 
-def run_mdmctl_get_devices(output_file):
-    console.print("📥 取得所有裝置資料...", style="bold blue")
-    command = f"{MDMCTL_BIN} get devices"
-    awk_cmd = "awk 'NR>1 && $1 != \"\" {print $1 \",\" $2}'"
-    full_cmd = f"{command} | {awk_cmd}"
-    with open(output_file, "w") as f:
-        subprocess.run(full_cmd, shell=True, stdout=f)
+class ActionProfiler:
+    """
+    以 cProfile、tracemalloc 與分段計時器分析每個選單功能。
+    批次功能在執行緒池中送出命令，worker 執行緒各自有一個 cProfile，輸出時與主執行緒合併；
+    worker 中的分段接在呼叫端的分段堆疊下，時間另外以「執行緒累計」統計，不與牆鐘時間混在一起。
+    """
 
-def get_device_from_net(server_url, api_key, output_file):
-    console.print("📥 取得所有裝置資料...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
+    def __init__(self, output_dir, top_n=20):
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.phase_lock = threading.Lock()
+        self.local = threading.local()
+        self.phase_totals = {}
+        self.thread_totals = {}
+        self.thread_profiles = []
+        self.action_id = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    @contextmanager
+    def action(self, name):
+        self.phase_totals = {}
+        self.thread_totals = {}
+        self.thread_profiles = []
+        self.action_id += 1
+        cprof = cProfile.Profile()
+        tracemalloc.start()
+        start = time.perf_counter()
+        cprof.enable()
+        try:
+            with self.phase(name):
+                yield
+        finally:
+            cprof.disable()
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.write_report(name, cprof, snapshot, peak, elapsed)
+
+    @contextmanager
+    def phase(self, name):
+        # 以執行緒各自的堆疊記錄巢狀分段，例如 option_3;selection;device_fetch
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(name)
+        key = tuple(stack)
+        totals = self.thread_totals if getattr(self.local, 'worker', False) else self.phase_totals
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self.phase_lock:
+                total, count = totals.get(key, (0.0, 0))
+                totals[key] = (total + elapsed, count + 1)
+
+    def thread_profile(self):
+        """目前 worker 執行緒在這次功能中使用的 cProfile（每個執行緒一個）"""
+        cached = getattr(self.local, 'profile', None)
+        if cached and cached[0] == self.action_id:
+            return cached[1]
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+            prof.disable()
+        except ValueError:
+            # Python 3.12 起 cProfile 改用 sys.monitoring，主執行緒的 profiler 已涵蓋所有執行緒
+            prof = None
+        self.local.profile = (self.action_id, prof)
+        if prof is not None:
+            with self.phase_lock:
+                self.thread_profiles.append(prof)
+        return prof
+
+    def wrap(self, func):
+        """讓送進執行緒池的 func 也被 cProfile 記錄，並沿用呼叫端目前的分段堆疊"""
+        parent = list(getattr(self.local, 'stack', None) or [])
+
+        def run(*args, **kwargs):
+            saved = getattr(self.local, 'stack', None), getattr(self.local, 'worker', False)
+            self.local.stack, self.local.worker = list(parent), True
+            prof = self.thread_profile()
+            if prof is not None:
+                prof.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if prof is not None:
+                    prof.disable()
+                self.local.stack, self.local.worker = saved
 
-    resp = requests.post(
-        f"{server_url}/v1/devices",
-        headers=headers,
-        auth=auth,
-        data=json.dumps({})
-    )
+        return run
 
-    if resp.status_code == 200:
-        data = resp.json()
-        with open(output_file, "w", newline='') as f:
+    def merged_stats(self, cprof):
+        stats = pstats.Stats(cprof)
+        for prof in self.thread_profiles:
+            try:
+                stats.add(prof)
+            except TypeError:
+                pass  # 沒有收集到任何資料的執行緒
+        return stats
+
+    @staticmethod
+    def self_times(totals):
+        """計算每個分段扣除子分段後的時間（flamegraph 需要的格式）"""
+        own = {key: total for key, (total, _) in totals.items()}
+        for key, (total, _) in totals.items():
+            parent = key[:-1]
+            if parent in own:
+                own[parent] -= total
+        return {key: max(value, 0.0) for key, value in own.items()}
+
+    def write_report(self, name, cprof, snapshot, peak, elapsed):
+        prefix = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}")
+
+        # cProfile 原始資料（主執行緒與 worker 合併），可用 snakeviz / flameprof 繪製火焰圖
+        stats = self.merged_stats(cprof)
+        stats.dump_stats(f"{prefix}.prof")
+
+        # 分段計時的 collapsed stack，可直接餵給 flamegraph.pl / speedscope：
+        # .folded 為主執行緒的牆鐘時間，.threads.folded 為 worker 執行緒的累計時間（會大於牆鐘時間）
+        for suffix, totals in ((".folded", self.phase_totals), (".threads.folded", self.thread_totals)):
+            with open(f"{prefix}{suffix}", "w") as f:
+                for key, seconds in sorted(self.self_times(totals).items()):
+                    f.write(f"{';'.join(key)} {int(seconds * 1_000_000)}\n")
+
+        thread_time = sum(total for key, (total, _) in self.thread_totals.items()
+                          if key[:-1] not in self.thread_totals)
+        with open(f"{prefix}.txt", "w") as f:
+            f.write(f"action: {name}\nwall: {elapsed:.3f}s\nworker thread time (summed): {thread_time:.3f}s\n"
+                    f"peak memory: {peak / 1024:.1f} KB\n\n")
+            f.write("== phases (wall, main thread) ==\n")
+            for key, (total, count) in sorted(self.phase_totals.items()):
+                f.write(f"{' > '.join(key):<60} {total:9.3f}s  x{count}\n")
+            f.write("\n== phases (summed across worker threads) ==\n")
+            for key, (total, count) in sorted(self.thread_totals.items()):
+                f.write(f"{' > '.join(key):<60} {total:9.3f}s  x{count}\n")
+            f.write(f"\n== top {self.top_n} functions (cumulative, all threads) ==\n")
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(self.top_n)
+            f.write(f"== top {self.top_n} allocations ==\n")
+            for stat in snapshot.statistics("lineno")[:self.top_n]:
+                f.write(f"{stat}\n")
+            f.write("\n== ack latency (s) ==\n")
+            for row in ack_latency.snapshot():
+                f.write(f"{row['request_type'] + ' / ' + row['status']:<60} n={row['count']:<6} "
+                        f"p50={row['p50']:.1f} p95={row['p95']:.1f} p99={row['p99']:.1f}\n")
+
+        table = Table(title=f"⏱️ 效能分析：{name}（牆鐘 {elapsed:.2f}s，worker 累計 {thread_time:.2f}s，"
+                            f"記憶體峰值 {peak / 1024:.0f} KB）")
+        table.add_column("分段", style="cyan")
+        table.add_column("計時", style="magenta")
+        table.add_column("總時間(s)", justify="right", style="green")
+        table.add_column("次數", justify="right")
+        phases = [(key, total, count, "牆鐘") for key, (total, count) in self.phase_totals.items()]
+        phases += [(key, total, count, "執行緒累計") for key, (total, count) in self.thread_totals.items()]
+        for key, total, count, kind in sorted(phases, key=lambda item: -item[1])[:self.top_n]:
+            table.add_row(" > ".join(key[1:]) or key[0], kind, f"{total:.3f}", str(count))
+        console.print(table)
+
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:self.top_n]
+        table = Table(title=f"🔥 前 {self.top_n} 名函式（累計時間）")
+        table.add_column("函式", style="cyan")
+        table.add_column("呼叫次數", justify="right")
+        table.add_column("累計(s)", justify="right", style="green")
+        for (filename, lineno, func), (_, ncalls, _, cumtime, _) in rows:
+            table.add_row(f"{os.path.basename(filename)}:{lineno}({func})", str(ncalls), f"{cumtime:.3f}")
+        console.print(table)
+        console.print(f"📁 分析結果已寫入 {prefix}.prof / .folded / .threads.folded / .txt", style="bold magenta")
+
+
+@contextmanager
+def profile_action(name):
+    if profiler is None:
+        yield
+        return
+    with profiler.action(name):
+        yield
+
+
+@contextmanager
+def profile_phase(name):
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
+
+
+def profile_threads(func):
+    """送進執行緒池前包裝 func，效能分析模式下 worker 也會被記錄"""
+    return profiler.wrap(func) if profiler is not None else func
+
+
+class CommandTracker:
+    """記錄已送出的命令（command_uuid → udid、request_type、送出時間），讓 ack 能對應回命令類型"""
+
+    FINAL_STATUSES = {"Acknowledged", "Error", "CommandFormatError"}
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.commands = OrderedDict()
+
+    def record(self, command_uuid, udid, request_type):
+        with self.lock:
+            self.commands[command_uuid] = {"udid": udid, "request_type": request_type, "sent_at": time.time()}
+            while len(self.commands) > self.max_size:
+                self.commands.popitem(last=False)
+
+    def resolve(self, command_uuid, status=None):
+        """找出 ack 對應的命令；最終狀態（非 NotNow）會一併移除"""
+        with self.lock:
+            if status in self.FINAL_STATUSES:
+                return self.commands.pop(command_uuid, None)
+            return self.commands.get(command_uuid)
+
+
+command_tracker = CommandTracker()
+
+
+class ResultSink:
+    """
+    把每台裝置的命令結果逐筆寫入 JSONL / CSV（收到就寫，不留在記憶體），
+    失敗的裝置另外寫成與 devices.csv 相同格式的清單，可在選擇裝置時直接重試。
+    """
+
+    FIELDS = ["time", "udid", "serial", "request_type", "status", "latency_ms", "command_uuid", "body"]
+    BODY_EXCERPT = 200
+
+    def __init__(self, name, directory=RESULTS_DIR, fmt=RESULT_FORMAT):
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.fmt = "csv" if fmt == "csv" else "jsonl"
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name}_{stamp}.{self.fmt}")
+        self.failed_path = os.path.join(directory, f"{name}_{stamp}_failed.csv")
+        self.lock = threading.Lock()
+        self.file = None
+        self.writer = None
+        self.failed_file = None
+        self.failed = set()
+        self.count = 0
+
+    def record(self, udid, request_type, status, latency, body="", command_uuid="", serial=""):
+        row = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "udid": udid,
+            "serial": serial or device_serials.get(udid, ""),
+            "request_type": request_type,
+            "status": status,
+            "latency_ms": round(latency * 1000, 1),
+            "command_uuid": command_uuid or "",
+            "body": (body or "")[:self.BODY_EXCERPT],
+        }
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.file = open(self.path, "w", newline='')
+                if self.fmt == "csv":
+                    self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+                    self.writer.writeheader()
+            if self.writer:
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.count += 1
+
+            if status not in (201, 202) and udid and udid not in self.failed:
+                self.failed.add(udid)
+                if self.failed_file is None:
+                    self.failed_file = open(self.failed_path, "w", newline='')
+                csv.writer(self.failed_file).writerow([udid, row["serial"]])
+                self.failed_file.flush()
+
+    def record_failure(self, udid, serial, reason):
+        """
+        記錄 post_command 以外看到的失敗（送出命令前的例外、Push 失敗），並加入失敗清單；
+        post_command 已記錄為失敗的裝置不重複寫入。
+        """
+        if udid not in self.failed:
+            self.record(udid, "", "error", 0.0, reason, serial=serial)
+
+    def close(self):
+        with self.lock:
+            for f in (self.file, self.failed_file):
+                if f is not None:
+                    f.close()
+        if self.count:
+            console.print(f"📝 已寫入 {self.count} 筆結果：{self.path}", style="bold cyan")
+        if self.failed:
+            console.print(f"❌ {len(self.failed)} 台裝置失敗，清單：{self.failed_path}"
+                          f"（選擇裝置時可用「5=重試失敗清單」）", style="bold red")
+
+
+active_sink = None
+
+
+@contextmanager
+def result_sink(name):
+    """在一次選單操作期間收集 post_command 的結果"""
+    global active_sink
+    active_sink = ResultSink(name)
+    try:
+        yield active_sink
+    finally:
+        sink, active_sink = active_sink, None
+        sink.close()
+
+
+def list_failed_results(directory=RESULTS_DIR):
+    """回傳失敗清單檔案，最新的在前"""
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith("_failed.csv")]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def post_command(server_url, api_key, payload):
+    """送出 MicroMDM 命令（/v1/commands），所有命令函式共用；依 udid 路由到裝置所屬的伺服器"""
+    udid, request_type = payload.get("udid"), payload.get("request_type")
+    sink = active_sink
+    if udid in deferring_udids:
+        deferred_commands.add(udid, payload)
+        if sink:
+            sink.record(udid, request_type, 202, 0.0, "deferred until next check-in")
+        return DeferredResponse()
+    started = time.perf_counter()
+    with profile_phase("dispatch"):
+        try:
+            resp = mdm_request(
+                "POST", server_url, api_key, "/v1/commands", udid=udid,
+                headers={"Content-Type": "application/json"},
+                data=json.dumps(payload)
+            )
+        except Exception as e:
+            if sink:
+                sink.record(udid, request_type, "error", time.perf_counter() - started, str(e))
+            raise
+    command_uuid = None
+    if resp.status_code == 201:
+        try:
+            command_uuid = resp.json()["payload"]["command_uuid"]
+            command_tracker.record(command_uuid, udid, request_type)
+        except (ValueError, KeyError, TypeError):
+            pass
+    if sink:
+        sink.record(udid, request_type, resp.status_code, time.perf_counter() - started, resp.text, command_uuid)
+    return resp
+
+
+# 每個伺服器共用一個 Session，讓並行請求重用連線
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_session(server_url, pool_size=MAX_WORKERS):
+    with http_sessions_lock:
+        session = http_sessions.get(server_url)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[server_url] = session
+        return session
+
+
+class RateLimiter:
+    """Token bucket，rate 為每秒請求數，0 表示不限制"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class MdmServer:
+    """一台 MicroMDM，各自有連線池大小與速率限制"""
+
+    def __init__(self, name, url, api_key, max_workers=MAX_WORKERS, rate_limit=0):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate_limit)
+
+
+def load_mdm_servers(path=MDM_SERVERS_FILE):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+        return [
+            MdmServer(
+                entry.get("name") or entry["url"],
+                entry["url"],
+                entry.get("api_key") or API_KEY,
+                int(entry.get("max_workers", MAX_WORKERS)),
+                float(entry.get("rate_limit", 0)),
+            )
+            for entry in entries
+        ]
+    return [MdmServer("default", MDM_URL, API_KEY)] if MDM_URL else []
+
+
+mdm_servers = None
+# udid → 所屬伺服器名稱 / 序號，由合併後的裝置清單建立
+device_homes = {}
+device_serials = {}
+
+
+def get_mdm_servers():
+    global mdm_servers
+    if mdm_servers is None:
+        mdm_servers = load_mdm_servers()
+    return mdm_servers
+
+
+def find_server(name=None, url=None):
+    for server in get_mdm_servers():
+        if (name is not None and server.name == name) or (url is not None and server.url == url):
+            return server
+    return None
+
+
+def mdm_request(method, server_url, api_key, path, udid=None, **kwargs):
+    """
+    送出 MicroMDM API 請求。已知裝置所屬伺服器時改送到該伺服器，
+    並使用該伺服器的連線池與速率限制；其他情況使用呼叫端給的 server_url / api_key。
+    """
+    server = find_server(name=device_homes.get(udid)) if udid else None
+    server = server or find_server(url=(server_url or "").rstrip("/"))
+    pool_size = MAX_WORKERS
+    if server:
+        server_url, api_key, pool_size = server.url, server.api_key, server.max_workers
+        server.limiter.acquire()
+    kwargs.setdefault("timeout", 60)
+    return get_session(server_url, pool_size).request(method, f"{server_url}{path}", auth=('micromdm', api_key),
+                                                      **kwargs)
+
+
+def run_sharded(items, func, max_workers=None, udid_of=lambda item: item[0]):
+    """
+    依裝置所屬伺服器分組，每個伺服器各自一個執行緒池同時執行，依完成順序產出 (item, result, error)。
+    max_workers 為每個伺服器的上限，不會超過伺服器設定的 max_workers。
+    items 可以是產生器：每個伺服器最多 IN_FLIGHT_FACTOR × 執行緒數 個工作在排隊或執行，
+    佇列滿時先產出已完成的結果再繼續讀取，不會一次把整個產生器讀進記憶體。
+    """
+    func = profile_threads(func)
+    executors = {}
+    limits = {}
+    in_flight = {}
+    pending = {}
+    try:
+        for item in items:
+            name = device_homes.get(udid_of(item))
+            executor = executors.get(name)
+            if executor is None:
+                server = find_server(name=name)
+                workers = server.max_workers if server else MAX_WORKERS
+                workers = min(workers, max_workers or workers)
+                executor = executors[name] = ThreadPoolExecutor(max_workers=workers)
+                limits[name] = workers * IN_FLIGHT_FACTOR
+                in_flight[name] = 0
+            while in_flight[name] >= limits[name]:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect_futures(done, pending, in_flight)
+            future = executor.submit(func, item)
+            pending[future] = (name, item)
+            in_flight[name] += 1
+            # 順便產出已完成的結果，讓呼叫端邊送邊處理
+            yield from collect_futures([f for f in pending if f.done()], pending, in_flight)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect_futures(done, pending, in_flight)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+
+def run_concurrently(items, func, max_workers=MAX_WORKERS):
+    """以執行緒池並行執行 func(item)，依完成順序產出 (item, result, error)；同樣限制排隊中的工作數"""
+    func = profile_threads(func)
+    limit = max_workers * IN_FLIGHT_FACTOR
+    in_flight = {None: 0}
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            while in_flight[None] >= limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect_futures(done, pending, in_flight)
+            pending[executor.submit(func, item)] = (None, item)
+            in_flight[None] += 1
+            yield from collect_futures([f for f in pending if f.done()], pending, in_flight)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect_futures(done, pending, in_flight)
+
+
+def collect_futures(done, pending, in_flight):
+    """產出已完成 future 的 (item, result, error)，並從排隊中的計數移除"""
+    for future in done:
+        name, item = pending.pop(future)
+        in_flight[name] -= 1
+        try:
+            yield item, future.result(), None
+        except Exception as e:
+            yield item, None, e
+
+
+def parse_timestamp(value):
+    """解析 MicroMDM (Go) 的 RFC3339 時間，零值時間回傳 None"""
+    if not value:
+        return None
+    # Go 可能輸出奈秒，Python 只接受到微秒
+    value = re.sub(r"(\.\d{6})\d+", r"\1", str(value)).replace("Z", "+00:00")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.year <= 1:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def to_json_safe(value):
+    """把 plist 解出的 datetime / bytes 轉成可寫入 JSON 的值"""
+    if isinstance(value, dict):
+        return {str(k): to_json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(v) for v in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    return value
+
+
+class PersistentStore:
+    """以 JSON 檔保存的本機快取，第一次使用時才讀檔，程式結束或每個功能結束時寫回"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = {}
+        self.loaded = False
+        self.dirty = False
+        PERSISTENT_STORES.append(self)
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self.data = json.load(f)
+                except (OSError, ValueError) as e:
+                    console.print(f"⚠️ 無法讀取快取 {self.path}：{e}", style="bold yellow")
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+PERSISTENT_STORES = []
+
+
+def flush_stores():
+    for store in PERSISTENT_STORES:
+        try:
+            store.save()
+        except OSError as e:
+            console.print(f"⚠️ 無法寫入快取 {store.path}：{e}", style="bold yellow")
+
+
+atexit.register(flush_stores)
+
+
+class EventCursor(PersistentStore):
+    """
+    relay 事件序號（seq）的續傳位置。重新連線時以 resume_from 要求補送，
+    epoch 代表 relay 的事件紀錄，relay 重建紀錄（序號重新起算）時位置歸零。
+    """
+
+    def last_seq(self):
+        self.ensure_loaded()
+        return self.data.get("last_seq", 0)
+
+    def epoch(self):
+        self.ensure_loaded()
+        return self.data.get("epoch")
+
+    def check_epoch(self, epoch):
+        if epoch is None:
+            return
+        self.ensure_loaded()
+        with self.lock:
+            if self.data.get("epoch") != epoch:
+                self.data = {"epoch": epoch, "last_seq": 0, "floor": 0, "window": [], "duplicates": 0}
+                self.dirty = True
+
+    def advance(self, seq):
+        """
+        記錄已處理的序號，回傳 False 表示重複事件。
+        以最近 EVENT_CURSOR_WINDOW 個已處理序號判斷重複，而不是只看最大值：
+        補送的舊事件與即時事件交錯送達時，序號較小的補送事件仍會被處理。
+        """
+        self.ensure_loaded()
+        with self.lock:
+            window = self.data.setdefault("window", [])
+            # 舊格式只有 last_seq：之前的事件都視為已處理
+            floor = self.data.setdefault("floor", self.data.get("last_seq", 0))
+            i = bisect.bisect_left(window, seq)
+            if seq <= floor or (i < len(window) and window[i] == seq):
+                self.data["duplicates"] = self.data.get("duplicates", 0) + 1
+                self.dirty = True
+                return False
+            window.insert(i, seq)
+            if len(window) > EVENT_CURSOR_WINDOW:
+                self.data["floor"] = window.pop(0)
+            self.data["last_seq"] = max(self.data.get("last_seq", 0), seq)
+            self.dirty = True
+            return True
+
+
+event_cursor = EventCursor(EVENT_CURSOR_PATH)
+
+
+# 裝置資料（facts / 已安裝 App / 遺失模式）變動時通知 listener(udid)，例如動態群組的增量更新
+fact_listeners = []
+
+
+def notify_fact_change(udid):
+    for listener in fact_listeners:
+        listener(udid)
+
+
+class DeviceFactsCache(PersistentStore):
+    """由 DeviceInformation / SecurityInfo 回應累積的裝置資訊，每個欄位各自有效期限"""
+
+    def update(self, udid, facts, now=None):
+        now = now or time.time()
+        self.ensure_loaded()
+        changed = False
+        with self.lock:
+            device = self.data.setdefault(udid, {})
+            for field, value in facts.items():
+                value = to_json_safe(value)
+                changed = changed or field not in device or device[field]["value"] != value
+                device[field] = {"value": value, "updated": now}
+            self.dirty = True
+        if changed:
+            notify_fact_change(udid)
+
+    def get(self, udid, fields=None, now=None, fresh_only=True):
+        now = now or time.time()
+        self.ensure_loaded()
+        with self.lock:
+            device = self.data.get(udid, {})
+            result = {}
+            for field, entry in device.items():
+                if fields is not None and field not in fields:
+                    continue
+                if fresh_only and now - entry["updated"] > FACT_TTLS.get(field, DEFAULT_FACT_TTL):
+                    continue
+                result[field] = entry["value"]
+            return result
+
+    def stale_fields(self, udid, fields, now=None):
+        fresh = self.get(udid, fields, now)
+        return [field for field in fields if field not in fresh]
+
+
+device_facts = DeviceFactsCache(DEVICE_FACTS_PATH)
+
+
+def version_tuple(version):
+    """把 "17.5.1" 之類的版本字串轉成可比較的 tuple"""
+    return tuple(int(part) for part in re.findall(r"\d+", str(version or "")))
+
+
+class InstalledAppIndex(PersistentStore):
+    """由 InstalledApplicationList 回應建立的已安裝 App 索引（udid → bundle id → 版本）"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.by_bundle = None
+
+    def ensure_loaded(self):
+        with self.lock:
+            super().ensure_loaded()
+            if self.by_bundle is None:
+                self.by_bundle = {}
+                for udid, entry in self.data.items():
+                    for bundle_id in entry["apps"]:
+                        self.by_bundle.setdefault(bundle_id, set()).add(udid)
+
+    def replace(self, udid, app_list, now=None):
+        """以裝置最新回報的清單取代舊資料，只調整有變動的反向索引"""
+        apps = {}
+        for app in app_list:
+            bundle_id = app.get("Identifier")
+            if bundle_id:
+                apps[bundle_id] = {
+                    "version": str(app.get("ShortVersion") or app.get("Version") or ""),
+                    "name": app.get("Name", ""),
+                }
+        self.ensure_loaded()
+        with self.lock:
+            old = set(self.data.get(udid, {}).get("apps", {}))
+            for bundle_id in old - set(apps):
+                self.by_bundle.get(bundle_id, set()).discard(udid)
+            for bundle_id in set(apps) - old:
+                self.by_bundle.setdefault(bundle_id, set()).add(udid)
+            self.data[udid] = {"updated": now or time.time(), "apps": apps}
+            self.dirty = True
+        notify_fact_change(udid)
+
+    def has_inventory(self, udid):
+        self.ensure_loaded()
+        return udid in self.data
+
+    def installed_version(self, udid, bundle_id):
+        self.ensure_loaded()
+        app = self.data.get(udid, {}).get("apps", {}).get(bundle_id)
+        return app["version"] if app else None
+
+    def plan_deployment(self, devices, bundle_id, version=None):
+        """
+        計算需要部署的裝置：
+        up_to_date = 已安裝目前版本，outdated = 版本較舊，missing = 未安裝，unknown = 沒有清單資料
+        """
+        self.ensure_loaded()
+        plan = {"up_to_date": [], "outdated": [], "missing": [], "unknown": []}
+        with self.lock:
+            holders = self.by_bundle.get(bundle_id, set())
+            for device in devices:
+                udid = device[0]
+                if udid not in self.data:
+                    plan["unknown"].append(device)
+                elif udid not in holders:
+                    plan["missing"].append(device)
+                elif version and version_tuple(self.installed_version(udid, bundle_id)) < version_tuple(version):
+                    plan["outdated"].append(device)
+                else:
+                    plan["up_to_date"].append(device)
+        return plan
+
+
+installed_apps = InstalledAppIndex(INSTALLED_APPS_PATH)
+
+
+def decode_ack_payload(ack_event):
+    """把 acknowledge_event 的 raw_payload（base64 或原始 bytes 的 plist）解成 dict，失敗回傳 None"""
+    raw = ack_event.get("raw_payload")
+    if not raw:
+        return None
+    try:
+        return plistlib.loads(raw_payload_bytes(raw))
+    except Exception:
+        return None
+
+
+class LostModeIndex(PersistentStore):
+    """裝置遺失模式狀態（udid → enabled），由 SecurityInfo / DeviceInformation 與遺失模式命令的 ack 更新"""
+
+    def set(self, udid, enabled, now=None):
+        self.ensure_loaded()
+        with self.lock:
+            changed = self.data.get(udid, {}).get("enabled") != bool(enabled)
+            self.data[udid] = {"enabled": bool(enabled), "updated": now or time.time()}
+            self.dirty = True
+        if changed:
+            notify_fact_change(udid)
+
+    def state(self, udid):
+        """回傳 True / False，沒有資料時回傳 None"""
+        self.ensure_loaded()
+        with self.lock:
+            entry = self.data.get(udid)
+            return entry["enabled"] if entry else None
+
+    def partition(self, devices):
+        groups = {True: [], False: [], None: []}
+        for device in devices:
+            groups[self.state(device[0])].append(device)
+        return groups[True], groups[False], groups[None]
+
+
+lost_mode_index = LostModeIndex(LOST_MODE_PATH)
+
+
+class LocationLog:
+    """裝置位置時間序列，以 JSONL 追加寫入"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, udid, location, now=None):
+        record = {
+            "udid": udid,
+            "received_at": datetime.fromtimestamp(now or time.time(), timezone.utc).isoformat(),
+            "latitude": location.get("Latitude"),
+            "longitude": location.get("Longitude"),
+            "horizontal_accuracy": location.get("HorizontalAccuracy"),
+            "altitude": location.get("Altitude"),
+            "speed": location.get("Speed"),
+            "timestamp": to_json_safe(location.get("Timestamp")),
+        }
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def history(self, udids, limit=10):
+        """逐行讀取，只保留每台裝置最後 limit 筆"""
+        udids = set(udids)
+        result = {udid: deque(maxlen=limit) for udid in udids}
+        if not os.path.exists(self.path):
+            return result
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("udid") in udids:
+                    result[record["udid"]].append(record)
+        return result
+
+
+location_log = LocationLog(DEVICE_LOCATIONS_PATH)
+
+
+# ack 回應類型以 raw_payload 中的特徵 key 判斷（依序比對，先符合者為準）
+ACK_RESPONSE_MARKERS = (
+    (b"<key>Latitude</key>", "DeviceLocation"),
+    (b"<key>InstalledApplicationList</key>", "InstalledApplicationList"),
+    (b"<key>CertificateList</key>", "CertificateList"),
+    (b"<key>ProfileList</key>", "ProfileList"),
+    (b"<key>SecurityInfo</key>", "SecurityInfo"),
+    (b"<key>AvailableOSUpdates</key>", "AvailableOSUpdates"),
+    (b"<key>QueryResponses</key>", "DeviceInformation"),
+)
+EVENT_RESPONSE_TYPES = [name for _, name in ACK_RESPONSE_MARKERS]
+COMMAND_UUID_RE = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+
+
+def classify_event(event):
+    """回傳 (事件種類, udid, command_uuid, 回應類型)；只比對 bytes，不解析 plist"""
+    for kind in EVENT_KIND_KEYS:
+        body = event.get(kind)
+        if not isinstance(body, dict):
+            continue
+        response = ""
+        if kind == "acknowledge_event" and body.get("raw_payload"):
+            try:
+                raw = raw_payload_bytes(body["raw_payload"])
+            except (ValueError, TypeError):
+                raw = b""
+            response = next((name for marker, name in ACK_RESPONSE_MARKERS if marker in raw), "")
+        return kind, body.get("udid"), body.get("command_uuid"), response
+    return event.get("topic", ""), None, None, ""
+
+
+class EventLogSegment:
+    """
+    單一 JSONL 分段的索引與讀取。索引大小有上限：
+    每 EVENT_LOG_TIME_STRIDE 筆一個 [時間, 位移] 的稀疏時間索引，
+    每台裝置每種回應類型只保留最近 EVENT_LOG_RECENT_PER_KEY 筆 [位移, 時間]，另記第一筆位移與總筆數；
+    需要更舊的資料或查 command_uuid 時，以 mmap.find 直接在檔案中跳到含該字串的行。
+    分段變大時只索引新增的部分。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx.json"
+        self.lock = threading.Lock()
+        self.index = None
+
+    def empty_index(self):
+        return {"version": 2, "indexed": 0, "records": 0, "udids": {}, "times": []}
+
+    def load(self):
+        with self.lock:
+            if self.index is None:
+                try:
+                    with open(self.index_path) as f:
+                        self.index = json.load(f)
+                except (OSError, ValueError):
+                    self.index = self.empty_index()
+            size = os.path.getsize(self.path)
+            if size < self.index["indexed"] or self.index.get("version") != 2:
+                # 檔案被截斷或換掉、或是舊版索引，重新建立
+                self.index = self.empty_index()
+            if size > self.index["indexed"]:
+                self.extend(size)
+                tmp_path = self.index_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.index, f)
+                os.replace(tmp_path, self.index_path)
+            return self.index
+
+    def unload(self):
+        with self.lock:
+            self.index = None
+
+    def extend(self, size):
+        index = self.index
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = index["indexed"]
+            while offset < size:
+                end = mm.find(b"\n", offset, size)
+                if end == -1:
+                    break  # 最後一行還沒寫完，下次再索引
+                try:
+                    record = json.loads(mm[offset:end])
+                except ValueError:
+                    offset = end + 1
+                    continue
+                ts = record.get("ts", 0)
+                kind, udid, _, response = classify_event(record.get("event") or {})
+                if index["records"] % EVENT_LOG_TIME_STRIDE == 0:
+                    index["times"].append([ts, offset])
+                if udid:
+                    entry = index["udids"].setdefault(udid, {"first": offset, "counts": {}, "recent": {}})
+                    key = response or kind
+                    recent = entry["recent"].setdefault(key, [])
+                    recent.append([offset, ts])
+                    if len(recent) > EVENT_LOG_RECENT_PER_KEY:
+                        del recent[0]
+                    entry["counts"][key] = entry["counts"].get(key, 0) + 1
+                index["records"] += 1
+                offset = end + 1
+            index["indexed"] = offset
+
+    def read(self, offsets):
+        """依位移讀出事件，不讀取整個檔案"""
+        offsets = list(offsets)
+        if not offsets:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset in offsets:
+                end = mm.find(b"\n", offset)
+                yield json.loads(mm[offset:end if end != -1 else len(mm)])
+
+    def lines_containing(self, needle, start=0, end=None):
+        """以 mmap.find 跳到含 needle 的行，依檔案順序產出 (位移, 事件)；不需要載入索引"""
+        if os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = len(mm) if end is None else end
+            pos = start
+            while True:
+                hit = mm.find(needle, pos, end)
+                if hit == -1:
+                    return
+                line_start = mm.rfind(b"\n", 0, hit) + 1
+                line_end = mm.find(b"\n", hit, end)
+                if line_end == -1:
+                    return
+                try:
+                    yield line_start, json.loads(mm[line_start:line_end])
+                except ValueError:
+                    pass
+                pos = line_end + 1
+
+    def find_udid(self, udid, response=None, since=None, limit=10):
+        """由新到舊找出這台裝置的事件；索引保留的筆數不夠時，才掃描檔案中這台裝置較舊的紀錄"""
+        index = self.load()
+        entry = index["udids"].get(udid)
+        if not entry:
+            return []
+        keys = [response] if response else list(entry["recent"])
+        hits = sorted((hit for key in keys for hit in entry["recent"].get(key, [])
+                       if since is None or hit[1] >= since), reverse=True)
+        truncated = any(entry["counts"].get(key, 0) > len(entry["recent"].get(key, [])) for key in keys)
+        if len(hits) >= limit or not truncated:
+            return list(self.read(offset for offset, _ in hits[:limit]))
+        matches = []
+        for offset, record in self.lines_containing(json.dumps(udid).encode(), entry["first"]):
+            if since is not None and record.get("ts", 0) < since:
+                continue
+            _, event_udid, _, kind = classify_event(record.get("event") or {})
+            if event_udid == udid and (not response or kind == response):
+                matches.append(record)
+        return matches[::-1][:limit]
+
+    def find_command(self, command_uuid):
+        """command_uuid 不建索引，直接以 mmap.find 搜尋"""
+        return [record for _, record in self.lines_containing(json.dumps(command_uuid).encode())
+                if classify_event(record.get("event") or {})[2] == command_uuid][::-1]
+
+    def scan_since(self, since):
+        """從稀疏時間索引找到起點，往後讀出 ts >= since 的事件"""
+        index = self.load()
+        points = index["times"]
+        if not points or index["indexed"] == 0:
+            return
+        start = bisect.bisect_right([ts for ts, _ in points], since) - 1
+        offset = points[max(start, 0)][1]
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset < index["indexed"]:
+                end = mm.find(b"\n", offset, index["indexed"])
+                if end == -1:
+                    break
+                try:
+                    record = json.loads(mm[offset:end])
+                except ValueError:
+                    record = None
+                if record and record.get("ts", 0) >= since:
+                    yield record
+                offset = end + 1
+
+
+class EventLogArchive:
+    """event_logs 目錄下所有分段；只有最近用到的 EVENT_LOG_CACHED_SEGMENTS 個分段索引留在記憶體"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = {}
+        self.cached = OrderedDict()
+
+    def list_segments(self):
+        """由新到舊"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((f for f in os.listdir(self.directory) if f.startswith("events-") and f.endswith(".jsonl")),
+                       reverse=True)
+        for name in names:
+            if name not in self.segments:
+                self.segments[name] = EventLogSegment(os.path.join(self.directory, name))
+        return [self.segments[name] for name in names]
+
+    def touch(self, segment):
+        self.cached[segment.path] = segment
+        self.cached.move_to_end(segment.path)
+        while len(self.cached) > EVENT_LOG_CACHED_SEGMENTS:
+            self.cached.popitem(last=False)[1].unload()
+
+    def query(self, udid=None, command_uuid=None, response=None, since=None, limit=10):
+        """
+        由新到舊找出符合的事件：指定 udid 時走索引，指定 command_uuid 時直接搜尋檔案，
+        兩者都沒有時依 since 以時間索引掃描；找到 limit 筆就不再讀更舊的分段。
+        """
+        results = []
+        for segment in self.list_segments():
+            if udid:
+                records = segment.find_udid(udid, response, since, limit - len(results))
+            elif command_uuid:
+                records = segment.find_command(command_uuid)
+            elif since is not None:
+                records = (record for record in reversed(list(segment.scan_since(since)))
+                           if not response or classify_event(record.get("event") or {})[3] == response)
+            else:
+                raise ValueError("需要 udid、command_uuid 或 since 其中之一")
+            self.touch(segment)
+            for record in records:
+                results.append(record)
+                if len(results) >= limit:
+                    return results
+        return results
+
+
+event_archive = EventLogArchive(EVENT_LOG_DIR)
+
+
+def ack_error_codes(payload):
+    return [e.get("ErrorCode") for e in payload.get("ErrorChain", []) if isinstance(e, dict)]
+
+
+def find_lost_mode_flag(values):
+    """在 QueryResponses / SecurityInfo 中找出遺失模式旗標"""
+    for key in ("IsMDMLostModeEnabled", "LostModeEnabled", "IsLostModeEnabled"):
+        if key in values:
+            return bool(values[key])
+    return None
+
+
+def record_ack_payload(udid, payload, request_type=None, status=None):
+    """把裝置回應寫入本機快取"""
+    if not udid or not isinstance(payload, dict):
+        return
+    status = status or payload.get("Status")
+
+    if status == "Error":
+        # 12067：裝置不在遺失模式（遺失模式專用命令才會回報）
+        if request_type in (None, "DeviceLocation", "PlayLostModeSound") and 12067 in ack_error_codes(payload):
+            lost_mode_index.set(udid, False)
+        return
+    if status != "Acknowledged":
+        return
+
+    if request_type == "EnableLostMode":
+        lost_mode_index.set(udid, True)
+    elif request_type == "DisableLostMode":
+        lost_mode_index.set(udid, False)
+
+    if isinstance(payload.get("QueryResponses"), dict):
+        device_facts.update(udid, payload["QueryResponses"])
+        flag = find_lost_mode_flag(payload["QueryResponses"])
+        if flag is not None:
+            lost_mode_index.set(udid, flag)
+    if isinstance(payload.get("SecurityInfo"), dict):
+        device_facts.update(udid, {"SecurityInfo": payload["SecurityInfo"]})
+        flag = find_lost_mode_flag(payload["SecurityInfo"])
+        if flag is not None:
+            lost_mode_index.set(udid, flag)
+    if isinstance(payload.get("InstalledApplicationList"), list):
+        installed_apps.replace(udid, payload["InstalledApplicationList"])
+    if isinstance(payload.get("AvailableOSUpdates"), list):
+        device_facts.update(udid, {"AvailableOSUpdates": payload["AvailableOSUpdates"]})
+    if "Latitude" in payload and "Longitude" in payload:
+        location_log.append(udid, payload)
+        lost_mode_index.set(udid, True)
+
+
+# 其他功能可註冊 listener(ack, sent)，sent 為 CommandTracker 記錄的命令（可能為 None）
+ack_listeners = []
+
+
+def handle_ack_event(ack):
+    """處理 acknowledge_event：對應回送出的命令並更新本機快取"""
+    status = ack.get("status")
+    if ack.get("udid"):
+        mark_device_seen(ack["udid"])
+    sent = command_tracker.resolve(ack.get("command_uuid"), status)
+    raw = ack.get("raw_payload")
+    if raw and payload_parser.should_offload(raw):
+        payload_parser.submit(raw, lambda payload: finish_ack_event(ack, sent, payload))
+        return
+    finish_ack_event(ack, sent, decode_ack_payload(ack) or {})
+
+
+def finish_ack_event(ack, sent, payload):
+    record_ack_payload(ack.get("udid"), payload, sent and sent["request_type"], ack.get("status"))
+    for listener in ack_listeners:
+        try:
+            listener(ack, sent)
+        except Exception as e:
+            console.print(f"[SocketIO] 處理 ack 發生錯誤：{e}", style="bold red")
+
+
+def parse_shared_payload(name, size):
+    """在子行程中解析共用記憶體裡的 plist（輸入不經過 pickle 傳送）"""
+    # 共用記憶體由主行程建立與釋放（unlink），子行程只讀取
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return plistlib.loads(bytes(block.buf[:size]))
+    finally:
+        block.close()
+
+
+class PayloadParser:
+    """
+    大型 raw_payload（整批 InstalledApplicationList / CertificateList 回應）交給子行程解析，
+    事件執行緒只負責 base64 解碼並把 bytes 放進共用記憶體，不會因為 plist 解析佔住 GIL。
+    """
+
+    def __init__(self, workers=PAYLOAD_PARSE_WORKERS, threshold=PAYLOAD_PARSE_THRESHOLD):
+        self.workers = workers
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.executor = None
+
+    @staticmethod
+    def size_of(raw):
+        # base64 字串約為原始大小的 4/3
+        return len(raw) if isinstance(raw, (bytes, bytearray, memoryview)) else len(raw) * 3 // 4
+
+    def should_offload(self, raw):
+        return self.workers > 0 and self.size_of(raw) >= self.threshold
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn：不從多執行緒的主行程 fork
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    def submit(self, raw, callback):
+        data = raw_payload_bytes(raw)
+        size = len(data)
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        block.buf[:size] = data
+        del data
+        future = self.get_executor().submit(parse_shared_payload, block.name, size)
+
+        def done(future):
+            block.close()
+            block.unlink()
+            try:
+                payload = future.result()
+            except Exception as e:
+                console.print(f"[SocketIO] 背景解析 raw_payload 失敗：{e}", style="bold red")
+                payload = {}
+            try:
+                callback(payload if isinstance(payload, dict) else {})
+            except Exception as e:
+                console.print(f"[SocketIO] 處理 ack 發生錯誤：{e}", style="bold red")
+
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+payload_parser = PayloadParser()
+atexit.register(payload_parser.shutdown)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+class AckLatencyStats:
+    """命令送出到收到 ack 的延遲，依 (request_type, status) 各保留最近 window 筆"""
+
+    def __init__(self, window=ACK_LATENCY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = Counter()
+
+    def record(self, ack, sent, now=None):
+        if not sent:
+            return
+        key = (sent["request_type"] or "Unknown", ack.get("status") or "Unknown")
+        latency = (now or time.time()) - sent["sent_at"]
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(latency)
+            self.counts[key] += 1
+
+    def snapshot(self):
+        with self.lock:
+            items = [(key, list(samples), self.counts[key]) for key, samples in self.samples.items()]
+        return [
+            {
+                "request_type": request_type,
+                "status": status,
+                "count": count,
+                "p50": percentile(samples, 50),
+                "p95": percentile(samples, 95),
+                "p99": percentile(samples, 99),
+            }
+            for (request_type, status), samples, count in sorted(items)
+        ]
+
+    def print_table(self):
+        rows = self.snapshot()
+        if not rows:
+            console.print("⚠️ 尚未收到任何可對應的 ack（需在本次執行中送出命令並連上 webhook）", style="bold yellow")
+            return
+        table = Table(title="📈 命令回應延遲（送出 → ack）")
+        table.add_column("命令類型", style="cyan")
+        table.add_column("狀態", style="green")
+        table.add_column("次數", justify="right")
+        table.add_column("p50(s)", justify="right")
+        table.add_column("p95(s)", justify="right")
+        table.add_column("p99(s)", justify="right")
+        for row in rows:
+            table.add_row(row["request_type"], row["status"], str(row["count"]),
+                          f"{row['p50']:.1f}", f"{row['p95']:.1f}", f"{row['p99']:.1f}")
+        console.print(table)
+
+
+ack_latency = AckLatencyStats()
+ack_listeners.append(ack_latency.record)
+
+
+def mark_device_seen(udid, now=None):
+    """check-in 或 ack 代表裝置在線：更新最後上線時間，並送出延後的命令"""
+    device_facts.update(udid, {"LastSeen": now or time.time()})
+    if deferred_commands.has(udid):
+        threading.Thread(target=deferred_commands.flush, args=(udid,), daemon=True).start()
+
+
+def partition_by_presence(devices, offline_after=OFFLINE_AFTER_HOURS * 3600, now=None):
+    """依最後上線時間分成 (在線, 離線)；沒有紀錄的裝置視為在線"""
+    now = now or time.time()
+    online, offline = [], []
+    for device in devices:
+        last_seen = device_facts.get(device[0], ["LastSeen"], fresh_only=False).get("LastSeen")
+        if last_seen and now - last_seen > offline_after:
+            offline.append(device)
+        else:
+            online.append(device)
+    return online, offline
+
+
+class DeferredResponse:
+    """命令被延後時 post_command 的回傳值，介面與 requests.Response 相同的部分"""
+
+    status_code = 202
+    text = "deferred until next check-in"
+
+    def json(self):
+        return {}
+
+
+# 本次操作中要延後送出命令的裝置（post_command / Push 會略過）
+deferring_udids = set()
+
+
+# 延後命令中不寫入檔案的欄位（鎖定 / 擦除 PIN），只保留在記憶體
+DEFERRED_SECRET_FIELDS = ("pin",)
+
+
+class DeferredCommands(PersistentStore):
+    """
+    離線裝置的延後命令（udid → 命令清單），裝置下次 check-in 時自動送出。
+    PIN 不寫入檔案；程式重新啟動後，含 PIN 的命令無法還原，送出時會略過並提示重新執行。
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.flushing = set()
+        self.secrets = {}
+
+    def add(self, udid, payload):
+        self.ensure_loaded()
+        stored = {k: v for k, v in payload.items() if k not in DEFERRED_SECRET_FIELDS}
+        secrets = {k: payload[k] for k in DEFERRED_SECRET_FIELDS if k in payload}
+        command = {"payload": stored, "deferred_at": time.time()}
+        if secrets:
+            command["id"] = os.urandom(8).hex()
+            command["redacted"] = sorted(secrets)
+        with self.lock:
+            if secrets:
+                self.secrets[command["id"]] = secrets
+            entry = self.data.setdefault(udid, {"home": device_homes.get(udid), "commands": []})
+            entry["commands"].append(command)
+            self.dirty = True
+
+    def has(self, udid):
+        self.ensure_loaded()
+        return udid in self.data
+
+    def udids(self):
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.data)
+
+    def flush(self, udid, server_url=None, api_key=None):
+        with self.lock:
+            # 本次操作還在延後這台裝置時先不送，等下一次 check-in
+            if udid in self.flushing or udid not in self.data or udid in deferring_udids:
+                return
+            self.flushing.add(udid)
+            entry = self.data.pop(udid)
+            self.dirty = True
+        try:
+            if entry.get("home"):
+                device_homes.setdefault(udid, entry["home"])
+            sent = 0
+            for command in entry["commands"]:
+                payload = dict(command["payload"])
+                if command.get("redacted"):
+                    with self.lock:
+                        secrets = self.secrets.pop(command["id"], None)
+                    if secrets is None:
+                        console.print(f"⚠️ 裝置 {udid} 的延後 {payload.get('request_type')} 含 PIN，"
+                                      f"程式重新啟動後未保存，請重新執行", style="bold yellow")
+                        continue
+                    payload.update(secrets)
+                resp = post_command(server_url or MDM_URL, api_key or API_KEY, payload)
+                if resp.status_code == 201:
+                    sent += 1
+            if sent:
+                send_push_to_device(server_url or MDM_URL, api_key or API_KEY, udid)
+            console.print(f"📤 裝置 {udid} 已上線，送出 {sent}/{len(entry['commands'])} 筆延後的命令",
+                          style="bold cyan")
+        finally:
+            with self.lock:
+                self.flushing.discard(udid)
+            self.save()
+        subscribe_events(checkin_udids=self.udids(), ack_udids=event_subscription.to_dict()["ack_udids"] + [udid])
+
+
+deferred_commands = DeferredCommands(DEFERRED_COMMANDS_PATH)
+
+
+def export_metrics(path=METRICS_PATH):
+    """把 ack 延遲與事件串流狀態寫成 JSON，供外部監控讀取"""
+    metrics = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "ack_latency": ack_latency.snapshot(),
+        "pending_commands": len(command_tracker.commands),
+        "event_stream": {
+            "last_seq": event_cursor.last_seq(),
+            "duplicates": event_cursor.data.get("duplicates", 0),
+        },
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return metrics
+
+
+GROUP_FIELDS = {"os_version", "model", "serial", "last_seen_days", "app", "lost_mode"}
+# 隨時間變動的欄位，這類群組在解析時會定期整批重算
+GROUP_TIME_FIELDS = {"last_seen_days"}
+GROUP_REFRESH_SECONDS = 60
+
+
+def parse_group_query(query):
+    """
+    解析動態群組條件，例如 "model contains iPad and os_version < 17 and last_seen_days > 7"，
+    回傳 [(欄位, 運算子, 值)]；條件之間只支援 and
+    """
+    clauses = []
+    pattern = r"(\w+)\s*(<=|>=|==|!=|<|>|=|\bcontains\b)\s*(.+)"
+    for part in re.split(r"\s+and\s+", query.strip(), flags=re.IGNORECASE):
+        match = re.fullmatch(pattern, part.strip(), flags=re.IGNORECASE)
+        if not match:
+            raise ValueError(f"無法解析條件：{part}")
+        field, op, value = match.group(1).lower(), match.group(2).lower(), match.group(3).strip().strip("\"'")
+        if field not in GROUP_FIELDS:
+            raise ValueError(f"不支援的欄位：{field}（可用：{', '.join(sorted(GROUP_FIELDS))}）")
+        if op == "=":
+            op = "=="
+        if field in ("app", "lost_mode") and op not in ("==", "!="):
+            raise ValueError(f"{field} 只支援 == / !=")
+        clauses.append((field, op, value))
+    return clauses
+
+
+def compare_values(left, op, right):
+    if op == "contains":
+        return str(right).lower() in str(left).lower()
+    if op == "==":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == ">":
+        return left > right
+    if op == "<=":
+        return left <= right
+    return left >= right
+
+
+def device_matches(udid, serial, clauses, now=None):
+    """以本機快取（不看有效期限）判斷裝置是否符合所有條件；沒有資料的欄位視為不符合"""
+    now = now or time.time()
+    facts = device_facts.get(udid, fresh_only=False)
+    for field, op, value in clauses:
+        if field == "app":
+            if not installed_apps.has_inventory(udid):
+                return False
+            installed = installed_apps.installed_version(udid, value) is not None
+            if installed != (op == "=="):
+                return False
+        elif field == "lost_mode":
+            state = lost_mode_index.state(udid)
+            if state is None or state != (value.lower() in ("true", "1", "yes")) ^ (op == "!="):
+                return False
+        elif field == "os_version":
+            if "OSVersion" not in facts:
+                return False
+            if op == "contains":
+                if not compare_values(facts["OSVersion"], op, value):
+                    return False
+            elif not compare_values(version_tuple(facts["OSVersion"]), op, version_tuple(value)):
+                return False
+        elif field == "model":
+            model = " ".join(str(facts[key]) for key in ("ModelName", "ProductName", "Model") if key in facts)
+            if not model:
+                return False
+            if op == "contains":
+                if not compare_values(model, op, value):
+                    return False
+            elif not any(compare_values(str(facts[key]).lower(), op, value.lower())
+                         for key in ("ModelName", "ProductName", "Model") if key in facts):
+                return False
+        elif field == "serial":
+            if not compare_values(serial.lower(), op, value.lower()):
+                return False
+        elif field == "last_seen_days":
+            if not facts.get("LastSeen"):
+                return False
+            if not compare_values((now - facts["LastSeen"]) / 86400, op, float(value)):
+                return False
+    return True
+
+
+class DeviceGroups(PersistentStore):
+    """
+    已儲存的裝置群組：static 為固定的 udid 清單，dynamic 為條件式（smart group）。
+    動態群組的成員以集合保存在記憶體，之後只重算資料有變動或新出現的裝置。
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.members = {}
+        self.evaluated = {}
+        self.evaluated_at = {}
+        self.pending = {}
+        fact_listeners.append(self.mark_changed)
+
+    def mark_changed(self, udid):
+        with self.lock:
+            for pending in self.pending.values():
+                pending.add(udid)
+
+    def names(self):
+        self.ensure_loaded()
+        return sorted(self.data)
+
+    def forget(self, name):
+        for cache in (self.members, self.evaluated, self.evaluated_at, self.pending):
+            cache.pop(name, None)
+
+    def save_static(self, name, devices):
+        self.ensure_loaded()
+        with self.lock:
+            self.data[name] = {"type": "static", "members": [udid for udid, _ in devices]}
+            self.forget(name)
+            self.dirty = True
+
+    def save_dynamic(self, name, query):
+        parse_group_query(query)
+        self.ensure_loaded()
+        with self.lock:
+            self.data[name] = {"type": "dynamic", "query": query}
+            self.forget(name)
+            self.dirty = True
+
+    def delete(self, name):
+        self.ensure_loaded()
+        with self.lock:
+            if self.data.pop(name, None) is not None:
+                self.forget(name)
+                self.dirty = True
+
+    def resolve(self, name, devices, now=None):
+        """回傳 devices 中屬於群組的裝置；動態群組第一次整批計算，之後只重算有變動的裝置"""
+        now = now or time.time()
+        self.ensure_loaded()
+        with self.lock:
+            group = self.data[name]
+            if group["type"] == "static":
+                members = set(group["members"])
+                return [d for d in devices if d[0] in members]
+
+            clauses = parse_group_query(group["query"])
+            time_based = any(field in GROUP_TIME_FIELDS for field, _, _ in clauses)
+            if name not in self.members or (
+                    time_based and now - self.evaluated_at[name] > GROUP_REFRESH_SECONDS):
+                self.members[name], self.evaluated[name] = set(), set()
+                self.evaluated_at[name] = now
+                candidates = devices
+            else:
+                pending = self.pending[name]
+                evaluated = self.evaluated[name]
+                candidates = [d for d in devices if d[0] in pending or d[0] not in evaluated]
+            self.pending[name] = set()
+
+            members = self.members[name]
+            for udid, serial in candidates:
+                self.evaluated[name].add(udid)
+                if device_matches(udid, serial, clauses, now):
+                    members.add(udid)
+                else:
+                    members.discard(udid)
+            return [d for d in devices if d[0] in members]
+
+
+device_groups = DeviceGroups(DEVICE_GROUPS_PATH)
+
+
+# 同時執行的 mdmctl 行程上限
+mdmctl_slots = threading.BoundedSemaphore(MDMCTL_MAX_PROCS)
+
+
+def run_mdmctl(args, timeout=MDMCTL_TIMEOUT):
+    """不經過 shell 執行 mdmctl，失敗（找不到執行檔、逾時）回傳 None"""
+    with mdmctl_slots:
+        try:
+            return subprocess.run([MDMCTL_BIN, *args], capture_output=True, text=True, timeout=timeout)
+        except FileNotFoundError:
+            console.print(f"❌ 找不到 {MDMCTL_BIN}", style="bold red")
+        except subprocess.TimeoutExpired:
+            console.print(f"❌ mdmctl {' '.join(args)} 逾時（{timeout} 秒）", style="bold red")
+    return None
+
+
+def iter_mdmctl_devices(timeout=MDMCTL_TIMEOUT):
+    """逐行讀取 mdmctl get devices 的輸出，產出 (udid, serial)；略過標題列"""
+    with mdmctl_slots:
+        proc = subprocess.Popen([MDMCTL_BIN, "get", "devices"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True)
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            header = True
+            for line in proc.stdout:
+                if header:
+                    header = False
+                    continue
+                fields = line.split()
+                if len(fields) >= 2:
+                    yield fields[0], fields[1]
+            stderr = proc.stderr.read()
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+        if returncode != 0:
+            raise RuntimeError(stderr.strip() or f"mdmctl 結束碼 {returncode}")
+
+
+def run_mdmctl_get_devices(output_file):
+    console.print("📥 取得所有裝置資料...", style="bold blue")
+    tmp_file = f"{output_file}.tmp"
+    count = 0
+    try:
+        with open(tmp_file, "w", newline='') as f:
             writer = csv.writer(f)
-            for device in data.get("devices", []):
-                udid = device.get("udid", "")
-                serial = device.get("serial_number", "")
+            for udid, serial in iter_mdmctl_devices():
                 writer.writerow([udid, serial])
-        console.print("✅ 成功取得裝置資料", style="green")
-    else:
-        console.print(f"❌ 錯誤：{resp.status_code}", style="bold red")
-        console.print(resp.text)
+                count += 1
+    except (OSError, RuntimeError) as e:
+        console.print(f"❌ mdmctl 取得裝置失敗：{e}", style="bold red")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+    # 成功才覆蓋，避免失敗時清空原本的裝置清單
+    os.replace(tmp_file, output_file)
+    console.print(f"✅ 透過 mdmctl 取得 {count} 台裝置", style="green")
+    return True
+
+
+def read_device_list(path):
+    """讀取裝置清單 CSV，回傳 [(udid, serial, 所屬伺服器)]；舊格式沒有第三欄時伺服器為空字串"""
+    rows = []
+    if not os.path.exists(path):
+        return rows
+    with open(path, newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) >= 2:
+                udid, serial = row[0].strip(), row[1].strip()
+                if udid and serial:
+                    rows.append((udid, serial, row[2].strip() if len(row) >= 3 else ""))
+    return rows
 
-    return resp.status_code
 
+def get_inventory(output_file):
+    """
+    並行向所有 MicroMDM 取得裝置並合併成一份清單（第三欄為所屬伺服器）。
+    個別伺服器失敗時沿用上次清單中該伺服器的裝置；全部失敗時回傳 None。
+    """
+    servers = get_mdm_servers()
+    console.print(f"📥 取得所有裝置資料（{len(servers)} 台伺服器）...", style="bold blue")
+    previous = read_device_list(output_file)
+    rows = []
+    succeeded = 0
+    for server, devices, error in run_concurrently(
+        servers, lambda server: fetch_devices(server.url, server.api_key), len(servers) or 1
+    ):
+        if error:
+            kept = [row for row in previous if row[2] == server.name]
+            console.print(f"❌ {server.name} 取得裝置失敗：{error}（沿用上次的 {len(kept)} 台）", style="bold red")
+            rows.extend(kept)
+            continue
+        succeeded += 1
+        for device in devices:
+            udid, serial = device.get("udid", ""), device.get("serial_number", "")
+            rows.append((udid, serial, server.name))
+            last_seen = parse_timestamp(device.get("last_seen"))
+            if udid and last_seen:
+                device_facts.update(udid, {"LastSeen": last_seen.timestamp()})
+    if not succeeded:
+        return None
+
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, "w", newline='') as f:
+        csv.writer(f).writerows(rows)
+    os.replace(tmp_file, output_file)
+    console.print(f"✅ 成功取得裝置資料（{len(rows)} 台）", style="green")
+    return rows
+
+
+@functools.lru_cache(maxsize=None)
 def load_sToken(vpptoken_path):
     with open(vpptoken_path, 'r') as f:
         encoded = f.read().strip()
         return encoded
 
 
+class VppLicenseLedger(PersistentStore):
+    """本機 VPP 授權帳本（adamId → 已綁定的序號），由 getVPPLicensesSrv 與每次分配結果更新"""
+
+    def is_licensed(self, adam_id, serial):
+        self.ensure_loaded()
+        with self.lock:
+            return serial in self.data.get(str(adam_id), {}).get("serials", {})
+
+    def set_serials(self, adam_id, associated=(), released=()):
+        self.ensure_loaded()
+        with self.lock:
+            entry = self.data.setdefault(str(adam_id), {"serials": {}, "since_modified_token": None})
+            for serial in associated:
+                entry["serials"][serial] = time.time()
+            for serial in released:
+                entry["serials"].pop(serial, None)
+            self.dirty = True
+
+    def sync(self, sToken, adam_id):
+        """
+        分頁取得目前的授權分配。已同步過的 adamId 會帶 sinceModifiedToken，只取回有變動的授權。
+        回傳本次處理的授權筆數，失敗回傳 None。
+        """
+        self.ensure_loaded()
+        adam_id = str(adam_id)
+        with self.lock:
+            since_token = self.data.get(adam_id, {}).get("since_modified_token")
+        session = get_session(VPP_SERVICE_URL)
+        batch_token = None
+        seen = 0
+        while True:
+            body = {"sToken": sToken, "adamId": adam_id, "assignedOnly": since_token is None}
+            if batch_token:
+                body["batchToken"] = batch_token
+            elif since_token:
+                body["sinceModifiedToken"] = since_token
+            try:
+                resp = session.post(f"{VPP_SERVICE_URL}/getVPPLicensesSrv", json=body, timeout=30)
+                data = resp.json()
+            except Exception as e:
+                console.print(f"⚠️ 無法同步 VPP 授權：{e}", style="bold yellow")
+                return None
+            if data.get("status") != 0:
+                console.print(f"⚠️ VPP 授權查詢失敗：{data.get('errorMessage', data)}", style="bold yellow")
+                return None
+
+            associated, released = [], []
+            for license_info in data.get("licenses", []):
+                serial = license_info.get("serialNumber")
+                if not serial:
+                    continue
+                if license_info.get("status", "Associated") == "Associated":
+                    associated.append(serial)
+                else:
+                    released.append(serial)
+            self.set_serials(adam_id, associated, released)
+            seen += len(data.get("licenses", []))
+
+            batch_token = data.get("batchToken")
+            if not batch_token:
+                with self.lock:
+                    self.data[adam_id]["since_modified_token"] = data.get("sinceModifiedToken") or since_token
+                    self.dirty = True
+                return seen
+
+
+vpp_licenses = VppLicenseLedger(VPP_LICENSES_PATH)
+
+
 def assign_vpp_license(sToken, adamId, serialNumber):
     console.print(f"🔑 分配 VPP 授權給序號 {serialNumber}...", style="bold green")
     data = {
@@ -159,22 +2250,30 @@ def assign_vpp_license(sToken, adamId, serialNumber):
         "adamIdStr": str(adamId),
         "associateSerialNumbers": [serialNumber]
     }
-    resp = requests.post(
-        "https://vpp.itunes.apple.com/mdm/manageVPPLicensesByAdamIdSrv",
+    resp = get_session(VPP_SERVICE_URL).post(
+        f"{VPP_SERVICE_URL}/manageVPPLicensesByAdamIdSrv",
         headers={"Content-Type": "application/json"},
         data=json.dumps(data)
     )
     console.print(f"✅ Apple 回應 ({serialNumber}):", resp.status_code, style="green")
     try:
-        console.print(resp.json())
+        result = resp.json()
+        console.print(result)
     except Exception:
         console.print(resp.text)
+        return resp.status_code
+
+    # 依回應更新本機帳本：沒有錯誤的序號視為已綁定
+    if result.get("status") == 0:
+        associations = result.get("associations") or [{"serialNumber": serialNumber}]
+        ok = [a.get("serialNumber") for a in associations
+              if a.get("serialNumber") and not a.get("errorMessage") and not a.get("errorNumber")]
+        vpp_licenses.set_serials(adamId, associated=ok)
+    return resp.status_code
 
 
 def install_app_to_device(server_url, api_key, udid, app_id):
     console.print(f"🚀 安裝 App 到 UDID={udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "InstallApplication",
@@ -183,7 +2282,7 @@ def install_app_to_device(server_url, api_key, udid, app_id):
             "purchase_method": 1
         }
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ MicroMDM 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -191,14 +2290,12 @@ def install_app_to_device(server_url, api_key, udid, app_id):
 
 def install_enterprise_app(server_url, api_key, udid, manifest_url):
     console.print(f"🚀 安裝企業 App 到 UDID={udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "InstallEnterpriseApplication",
         "manifest_url": manifest_url
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ MicroMDM 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -206,8 +2303,6 @@ def install_enterprise_app(server_url, api_key, udid, manifest_url):
 
 def lock_device(server_url, api_key, udid, pin=None, message=None):
     console.print(f"🔒 鎖定裝置 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DeviceLock"
@@ -217,7 +2312,7 @@ def lock_device(server_url, api_key, udid, pin=None, message=None):
     if message:
         payload["message"] = message
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 鎖定結果 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -225,13 +2320,11 @@ def lock_device(server_url, api_key, udid, pin=None, message=None):
 
 def restart_device(server_url, api_key, udid):
     console.print(f"🔄 重開機 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "RestartDevice"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 重開機回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp
@@ -247,22 +2340,12 @@ def shutdown_device(server_url, api_key, udid):
     """
     console.print(f"⏹️ 正在關機 {udid}...", style="bold red")
 
-    headers = {
-        "Content-Type": "application/json"
-    }
-    auth = ('micromdm', api_key)
-
     payload = {
         "udid": udid,
         "request_type": "ShutDownDevice"
     }
 
-    resp = requests.post(
-        f"{server_url}/v1/commands",
-        headers=headers,
-        auth=auth,
-        data=json.dumps(payload)
-    )
+    resp = post_command(server_url, api_key, payload)
 
     console.print(f"🔌 關機回應 ({udid}): {resp.status_code}", style="green")
     console.print(resp.text)
@@ -270,13 +2353,11 @@ def shutdown_device(server_url, api_key, udid):
 
 def clear_passcode(server_url, api_key, udid):
     console.print(f"🔓 清除密碼 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "ClearPasscode"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 清除密碼回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -284,8 +2365,6 @@ def clear_passcode(server_url, api_key, udid):
 
 def erase_device(server_url, api_key, udid, pin=None):
     console.print(f"💥 擦除裝置 {udid}...", style="bold red")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "EraseDevice"
@@ -293,7 +2372,7 @@ def erase_device(server_url, api_key, udid, pin=None):
     if pin:
         payload["pin"] = pin
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 擦除回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -301,45 +2380,48 @@ def erase_device(server_url, api_key, udid, pin=None):
 
 def remove_application(server_url, api_key, udid, identifier="*"):
     console.print(f"🧹 移除應用程式 {identifier} 從 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "RemoveApplication",
         "identifier": identifier
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
 
 
-def get_device_info(server_url, api_key, udid):
+def get_device_info(server_url, api_key, udid, queries=None):
     console.print(f"📊 獲取裝置詳細資訊 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DeviceInformation",
-        "queries": [
-            "UDID", "DeviceName", "OSVersion",
-        ]
+        "queries": queries or DEVICE_INFO_QUERIES
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
 
 
+def print_cached_facts(devices, fields):
+    table = Table(title="📊 裝置資訊（快取）")
+    table.add_column("SerialNumber", style="green")
+    for field in fields:
+        table.add_column(field, style="cyan")
+    for udid, serial in devices:
+        facts = device_facts.get(udid, fields)
+        table.add_row(serial, *[str(facts.get(field, "")) for field in fields])
+    console.print(table)
+
+
 def get_installed_apps(server_url, api_key, udid):
     console.print(f"📋 獲取已安裝應用程式清單 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "InstalledApplicationList"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -347,13 +2429,11 @@ def get_installed_apps(server_url, api_key, udid):
 
 def get_profiles(server_url, api_key, udid):
     console.print(f"📋 獲取已安裝描述檔清單 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "ProfileList"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -361,23 +2441,28 @@ def get_profiles(server_url, api_key, udid):
 
 def get_os_updates(server_url, api_key, udid):
     console.print(f"🔍 查詢可用系統更新 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "AvailableOSUpdates"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
 
 
-def schedule_os_update(server_url, api_key, udid, product_key, product_version, install_action="InstallASAP"):
+def schedule_os_update(server_url, api_key, udid, product_key, product_version, install_action="InstallASAP",
+                       priority="High"):
     console.print(f"📲 排程系統更新 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
-    payload = {
+    resp = post_command(server_url, api_key, os_update_payload(udid, product_key, product_version, install_action,
+                                                               priority))
+    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
+    console.print(resp.text)
+    return resp.status_code
+
+
+def os_update_payload(udid, product_key, product_version, install_action="InstallASAP", priority="High"):
+    return {
         "udid": udid,
         "request_type": "ScheduleOSUpdate",
         "updates": [
@@ -386,22 +2471,229 @@ def schedule_os_update(server_url, api_key, udid, product_key, product_version,
                 "product_key": product_key,
                 "product_version": product_version,
                 "max_user_deferrals": 1,
-                "priority": "High"
+                "priority": priority
             }
         ],
         "command_uuid": f"update_{int(time.time())}"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
-    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
-    console.print(resp.text)
-    return resp.status_code
+
+
+OS_UPDATE_INSTALL_ACTIONS = {
+    "1": "InstallASAP",
+    "2": "DownloadOnly",
+    "3": "NotifyOnly",
+    "4": "InstallLater",
+    "5": "InstallForceRestart"
+}
+
+
+def ask_install_action():
+    console.print("安裝動作選項:")
+    for key, val in OS_UPDATE_INSTALL_ACTIONS.items():
+        console.print(f"{key}. {val}")
+    action_choice = Prompt.ask("請選擇安裝動作", choices=list(OS_UPDATE_INSTALL_ACTIONS.keys()), default="1")
+    return OS_UPDATE_INSTALL_ACTIONS[action_choice]
+
+
+def os_update_skip_reason(udid, product_version):
+    """依快取判斷是否不需更新：已是目標版本，或可用更新清單中沒有此版本"""
+    os_version = device_facts.get(udid, ["OSVersion"], fresh_only=False).get("OSVersion")
+    if os_version and version_tuple(os_version) >= version_tuple(product_version):
+        return f"已是 {os_version}"
+    updates = device_facts.get(udid, ["AvailableOSUpdates"]).get("AvailableOSUpdates")
+    if updates is not None and not any(
+        version_tuple(u.get("ProductVersion") or u.get("Version")) == version_tuple(product_version)
+        for u in updates if isinstance(u, dict)
+    ):
+        return "可用更新中沒有此版本"
+    return None
+
+
+class OsUpdateCampaign(PersistentStore):
+    """
+    分批系統更新：先送 canary，再以固定大小分批送出；
+    每批需收到足夠的成功 ack 才會進行下一批，狀態保存在 JSON 以便中斷後續跑。
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        ack_listeners.append(self.on_ack)
+
+    def active(self):
+        self.ensure_loaded()
+        return bool(self.data) and self.data.get("state") not in ("done", "aborted")
+
+    def create(self, devices, product_key, product_version, install_action, priority="Low", canary_pct=5.0,
+               wave_size=50, concurrency=10, pacing=60, success_threshold=0.9, wave_timeout=1800):
+        eligible, skipped = [], {}
+        for udid, serial in devices:
+            reason = os_update_skip_reason(udid, product_version)
+            if reason:
+                skipped[udid] = {"serial": serial, "status": "skipped", "reason": reason, "wave": None}
+            else:
+                eligible.append((udid, serial))
+
+        canary = max(1, int(len(eligible) * canary_pct / 100 + 0.999)) if eligible else 0
+        waves = [eligible[:canary]] if canary else []
+        waves += [eligible[i:i + wave_size] for i in range(canary, len(eligible), wave_size)]
+
+        campaign_devices = dict(skipped)
+        for index, wave in enumerate(waves):
+            for udid, serial in wave:
+                campaign_devices[udid] = {"serial": serial, "status": "pending", "reason": None, "wave": index}
+        with self.lock:
+            self.ensure_loaded()
+            self.data = {
+                "id": time.strftime("%Y%m%d-%H%M%S"),
+                "state": "running" if waves else "done",
+                "product_key": product_key,
+                "product_version": product_version,
+                "install_action": install_action,
+                "priority": priority,
+                "concurrency": concurrency,
+                "pacing": pacing,
+                "success_threshold": success_threshold,
+                "wave_timeout": wave_timeout,
+                "waves": [[udid for udid, _ in wave] for wave in waves],
+                "current_wave": 0,
+                "devices": campaign_devices,
+            }
+            self.dirty = True
+        self.save()
+
+    def set_status(self, udid, status, **extra):
+        with self.lock:
+            device = self.data["devices"][udid]
+            device["status"] = status
+            device.update(extra)
+            self.dirty = True
+
+    def tracked_udids(self):
+        """還在等待送出或 ack 的裝置，用來向 relay 訂閱"""
+        self.ensure_loaded()
+        with self.lock:
+            return [udid for udid, device in self.data.get("devices", {}).items()
+                    if device["status"] in ("pending", "sent")]
+
+    def on_ack(self, ack, sent):
+        """
+        以活動狀態中保存的 command_uuid 比對，重新啟動後（CommandTracker 已清空）仍能認得之前送出的命令；
+        沒有 command_uuid 的裝置（例如延後送出）才依 CommandTracker 的命令類型判斷。
+        """
+        self.ensure_loaded()
+        with self.lock:
+            device = self.data.get("devices", {}).get(ack.get("udid"))
+            if not device or device["status"] != "sent":
+                return
+            if device.get("command_uuid"):
+                if ack.get("command_uuid") != device["command_uuid"]:
+                    return
+            elif not sent or sent["request_type"] != "ScheduleOSUpdate":
+                return
+            if ack.get("status") == "Acknowledged":
+                self.set_status(ack["udid"], "acked")
+            elif ack.get("status") in ("Error", "CommandFormatError"):
+                self.set_status(ack["udid"], "failed")
+
+    def wave_counts(self, index):
+        with self.lock:
+            return Counter(self.data["devices"][udid]["status"] for udid in self.data["waves"][index])
+
+    def dispatch_wave(self, server_url, api_key, index):
+        campaign = self.data
+        pending = [(udid, campaign["devices"][udid]["serial"]) for udid in campaign["waves"][index]
+                   if campaign["devices"][udid]["status"] == "pending"]
+
+        def send(device):
+            resp = post_command(server_url, api_key, os_update_payload(
+                device[0], campaign["product_key"], campaign["product_version"], campaign["install_action"],
+                campaign["priority"]))
+            command_uuid = None
+            if resp.status_code == 201:
+                try:
+                    command_uuid = resp.json()["payload"]["command_uuid"]
+                except (ValueError, KeyError, TypeError):
+                    pass
+                send_push_to_device(server_url, api_key, device[0])
+            return resp.status_code, command_uuid
+
+        for (udid, _), result, error in run_sharded(pending, send, campaign["concurrency"]):
+            if error or result[0] not in (201, 202):
+                self.set_status(udid, "failed", reason=str(error or result[0]))
+            else:
+                # 202 = 裝置離線、命令已延後，ack 時依 udid 與命令類型比對
+                self.set_status(udid, "sent", sent_at=time.time(), command_uuid=result[1])
+        self.save()
+
+    def wait_for_wave(self, index, poll_interval=5):
+        """等待這一批的成功 ack 達到門檻；逾時或失敗過多回傳 False"""
+        campaign = self.data
+        size = len(campaign["waves"][index])
+        needed = campaign["success_threshold"] * size
+        deadline = time.time() + campaign["wave_timeout"]
+        while True:
+            counts = self.wave_counts(index)
+            console.print(
+                f"🌊 第 {index + 1}/{len(campaign['waves'])} 批：成功 {counts['acked']}、等待中 {counts['sent']}、"
+                f"失敗 {counts['failed']}（門檻 {needed:.0f}/{size}）", style="cyan"
+            )
+            if counts["acked"] >= needed:
+                return True
+            if size - counts["failed"] < needed:
+                console.print("❌ 失敗數已超過門檻，暫停活動", style="bold red")
+                return False
+            if time.time() >= deadline:
+                console.print("⏳ 等待逾時，暫停活動（可稍後續跑）", style="bold yellow")
+                return False
+            time.sleep(poll_interval)
+
+    def run(self, server_url, api_key):
+        campaign = self.data
+        subscribe_events(udids=self.tracked_udids(), request_types=(), command_uuids=())
+        try:
+            while campaign["current_wave"] < len(campaign["waves"]):
+                index = campaign["current_wave"]
+                with profile_phase("dispatch_wave"):
+                    self.dispatch_wave(server_url, api_key, index)
+                with profile_phase("wait"):
+                    succeeded = self.wait_for_wave(index)
+                if not succeeded:
+                    campaign["state"] = "paused"
+                    return False
+                with self.lock:
+                    campaign["current_wave"] += 1
+                    self.dirty = True
+                self.save()
+                if campaign["current_wave"] < len(campaign["waves"]):
+                    console.print(f"⏸️ 間隔 {campaign['pacing']} 秒後開始下一批", style="blue")
+                    time.sleep(campaign["pacing"])
+            campaign["state"] = "done"
+            return True
+        except KeyboardInterrupt:
+            console.print("⏸️ 已中斷，活動狀態已保存，可稍後續跑", style="bold yellow")
+            campaign["state"] = "paused"
+            return False
+        finally:
+            self.dirty = True
+            self.save()
+
+    def print_summary(self):
+        campaign = self.data
+        counts = Counter(d["status"] for d in campaign["devices"].values())
+        console.print(
+            f"📋 活動 {campaign['id']}（{campaign['product_version']}，{campaign['state']}）："
+            f"共 {len(campaign['waves'])} 批，目前第 {min(campaign['current_wave'] + 1, len(campaign['waves']))} 批；"
+            f"成功 {counts['acked']}、已送出 {counts['sent']}、待送 {counts['pending']}、"
+            f"失敗 {counts['failed']}、略過 {counts['skipped']}",
+            style="bold green"
+        )
+
+
+os_update_campaign = OsUpdateCampaign(OS_UPDATE_CAMPAIGN_PATH)
 
 
 def install_profile(server_url, api_key, udid, profile_path):
     console.print(f"📝 安裝描述檔到 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
-
     # 讀取 profile 並進行 base64 編碼
     with open(profile_path, 'rb') as f:
         content = f.read()
@@ -412,7 +2704,7 @@ def install_profile(server_url, api_key, udid, profile_path):
         "request_type": "InstallProfile",
         "payload": payload_base64
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -420,14 +2712,12 @@ def install_profile(server_url, api_key, udid, profile_path):
 
 def remove_profile(server_url, api_key, udid, identifier):
     console.print(f"🗑️ 移除描述檔 {identifier} 從 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "RemoveProfile",
         "identifier": identifier
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -435,8 +2725,6 @@ def remove_profile(server_url, api_key, udid, identifier):
 
 def setup_account(server_url, api_key, udid, fullname, username, lock_info=True):
     console.print(f"👤 設定裝置帳號 {username} 到 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "AccountConfiguration",
@@ -447,7 +2735,7 @@ def setup_account(server_url, api_key, udid, fullname, username, lock_info=True)
         "primary_account_full_name": fullname,
         "primary_account_user_name": username
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -455,14 +2743,12 @@ def setup_account(server_url, api_key, udid, fullname, username, lock_info=True)
 
 def device_configured(server_url, api_key, udid):
     console.print(f"✅ 標記裝置已配置完成 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DeviceConfigured",
         "request_requires_network_tether": False
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -470,13 +2756,11 @@ def device_configured(server_url, api_key, udid):
 
 def get_activation_lock_bypass(server_url, api_key, udid):
     console.print(f"🔑 獲取啟用鎖繞過碼 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "ActivationLockBypassCode"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -484,13 +2768,11 @@ def get_activation_lock_bypass(server_url, api_key, udid):
 
 def get_security_info(server_url, api_key, udid):
     console.print(f"🔒 獲取安全資訊 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "SecurityInfo"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -498,81 +2780,608 @@ def get_security_info(server_url, api_key, udid):
 
 def get_certificate_list(server_url, api_key, udid):
     console.print(f"🔐 獲取憑證清單 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "CertificateList"
     }
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
 
 
-def clear_command_queue(server_url, api_key, udid):
-    console.print(f"🧹 清除命令佇列 {udid}...", style="bold blue")
-    auth = ('micromdm', api_key)
-    resp = requests.delete(f"{server_url}/v1/commands/{udid}", auth=auth)
-    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
-    console.print(resp.text)
-    return resp.status_code
+def clear_command_queue(server_url, api_key, udid):
+    console.print(f"🧹 清除命令佇列 {udid}...", style="bold blue")
+    resp = mdm_request("DELETE", server_url, api_key, f"/v1/commands/{udid}", udid=udid)
+    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
+    console.print(resp.text)
+    return resp.status_code
+
+
+def inspect_command_queue(server_url, api_key, udid):
+    console.print(f"🔍 檢查命令佇列 {udid}...", style="bold blue")
+    resp = mdm_request("GET", server_url, api_key, f"/v1/commands/{udid}", udid=udid)
+    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
+    console.print(resp.text)
+    return resp.status_code
+
+
+def parse_queued_command(entry):
+    """把 /v1/commands/{udid} 的單筆佇列項目轉成 {uuid, request_type, created_at, pending}"""
+    item = {str(k).lower(): v for k, v in entry.items()}
+    request_type = item.get("request_type") or item.get("requesttype")
+    payload = item.get("payload")
+    if not request_type and payload:
+        try:
+            command = plistlib.loads(base64.b64decode(payload))
+            request_type = command.get("Command", {}).get("RequestType")
+        except Exception:
+            request_type = None
+    acknowledged = parse_timestamp(item.get("acknowledged"))
+    return {
+        "uuid": item.get("uuid") or item.get("command_uuid", ""),
+        "request_type": request_type or "Unknown",
+        "created_at": parse_timestamp(item.get("created_at") or item.get("createdat")),
+        "pending": acknowledged is None,
+    }
+
+
+def fetch_command_queue(server_url, api_key, udid):
+    """取得裝置命令佇列並解析成清單"""
+    resp = mdm_request("GET", server_url, api_key, f"/v1/commands/{udid}", udid=udid, timeout=30)
+    resp.raise_for_status()
+    data = resp.json() if resp.text.strip() else {}
+    entries = data.get("commands", []) if isinstance(data, dict) else data
+    return [parse_queued_command(entry) for entry in entries or []]
+
+
+def summarize_command_queue(commands, now=None):
+    now = now or datetime.now(timezone.utc)
+    pending = [c for c in commands if c["pending"]]
+    created = [c["created_at"] for c in pending if c["created_at"]]
+    oldest = min(created) if created else None
+    return {
+        "depth": len(pending),
+        "oldest": oldest,
+        "oldest_age": (now - oldest) if oldest else None,
+        "types": Counter(c["request_type"] for c in pending),
+    }
+
+
+def survey_command_queues(server_url, api_key, devices, max_workers=MAX_WORKERS):
+    """並行取得所有裝置的命令佇列並彙整"""
+    console.print(f"📊 並行檢查 {len(devices)} 台裝置的命令佇列（{max_workers} 個連線）...", style="bold blue")
+    now = datetime.now(timezone.utc)
+    summaries = []
+    failures = []
+    with profile_phase("queue_fetch"):
+        for (udid, serial), commands, error in run_sharded(
+            devices, lambda device: fetch_command_queue(server_url, api_key, device[0]), max_workers
+        ):
+            if error:
+                failures.append((udid, serial, str(error)))
+                continue
+            summary = summarize_command_queue(commands, now)
+            summary.update(udid=udid, serial=serial)
+            summaries.append(summary)
+    summaries.sort(key=lambda s: (-s["depth"], s["oldest"] or now))
+    return summaries, failures
+
+
+def format_age(delta):
+    if delta is None:
+        return "-"
+    seconds = int(delta.total_seconds())
+    if seconds >= 86400:
+        return f"{seconds // 86400}d{seconds % 86400 // 3600}h"
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60}m"
+    return f"{seconds // 60}m"
+
+
+def print_queue_survey(summaries, failures, top_n=20):
+    total_types = Counter()
+    for summary in summaries:
+        total_types.update(summary["types"])
+    backlogged = [s for s in summaries if s["depth"]]
+
+    console.print(
+        f"📊 共 {len(summaries)} 台裝置，{len(backlogged)} 台有待處理命令，"
+        f"合計 {sum(total_types.values())} 筆", style="bold green"
+    )
 
+    table = Table(title=f"🚦 佇列最塞的前 {min(top_n, len(backlogged))} 台裝置")
+    table.add_column("排名", justify="right", style="cyan")
+    table.add_column("SerialNumber", style="green")
+    table.add_column("UDID", style="blue")
+    table.add_column("待處理", justify="right", style="bold red")
+    table.add_column("最舊命令", justify="right", style="yellow")
+    table.add_column("命令類型")
+    for rank, summary in enumerate(backlogged[:top_n], 1):
+        types = ", ".join(f"{name}×{count}" for name, count in summary["types"].most_common(3))
+        table.add_row(
+            str(rank), summary["serial"], summary["udid"], str(summary["depth"]),
+            format_age(summary["oldest_age"]), types
+        )
+    console.print(table)
 
-def inspect_command_queue(server_url, api_key, udid):
-    console.print(f"🔍 檢查命令佇列 {udid}...", style="bold blue")
-    auth = ('micromdm', api_key)
-    resp = requests.get(f"{server_url}/v1/commands/{udid}", auth=auth)
-    console.print(f"✅ 回應 ({udid}):", resp.status_code, style="green")
-    console.print(resp.text)
+    table = Table(title="📋 各命令類型待處理數量")
+    table.add_column("RequestType", style="green")
+    table.add_column("數量", justify="right", style="cyan")
+    for name, count in total_types.most_common():
+        table.add_row(name, str(count))
+    console.print(table)
+
+    if failures:
+        console.print(f"❌ {len(failures)} 台裝置無法取得佇列：", style="bold red")
+        for udid, serial, error in failures[:top_n]:
+            console.print(f"  {serial} ({udid}): {error}")
+
+
+def select_prunable_commands(commands, max_age=None, request_types=None, now=None):
+    """挑出符合條件的待處理命令；同時指定時需兩個條件都符合"""
+    now = now or datetime.now(timezone.utc)
+    matched = []
+    for command in commands:
+        if not command["pending"]:
+            continue
+        if max_age is not None and (command["created_at"] is None or now - command["created_at"] < max_age):
+            continue
+        if request_types and command["request_type"] not in request_types:
+            continue
+        matched.append(command)
+    return matched
+
+
+def delete_command_queue(server_url, api_key, udid):
+    resp = mdm_request("DELETE", server_url, api_key, f"/v1/commands/{udid}", udid=udid, timeout=30)
+    resp.raise_for_status()
     return resp.status_code
 
 
+def prune_command_queues(server_url, api_key, devices, max_age=None, request_types=None, dry_run=True,
+                         max_workers=MAX_WORKERS):
+    """
+    依命令年齡或類型清理佇列。
+    MicroMDM 只提供整個佇列的 DELETE，因此只有「所有待處理命令都符合條件」的裝置會被清除，
+    部分符合的裝置會列為 partial，不會動到其他命令。
+    """
+    now = datetime.now(timezone.utc)
+    plans = []
+    with profile_phase("queue_fetch"):
+        for (udid, serial), commands, error in run_sharded(
+            devices, lambda device: fetch_command_queue(server_url, api_key, device[0]), max_workers
+        ):
+            if error:
+                plans.append({"udid": udid, "serial": serial, "action": "error", "error": str(error),
+                              "before": None, "prunable": 0, "types": Counter(), "after": None})
+                continue
+            depth = sum(1 for c in commands if c["pending"])
+            prunable = select_prunable_commands(commands, max_age, request_types, now)
+            if not prunable:
+                action = "keep"
+            elif len(prunable) == depth:
+                action = "clear"
+            else:
+                action = "partial"
+            plans.append({"udid": udid, "serial": serial, "action": action, "error": None, "before": depth,
+                          "prunable": len(prunable), "types": Counter(c["request_type"] for c in prunable),
+                          "after": depth})
+
+    if dry_run:
+        return plans
+
+    to_clear = [p for p in plans if p["action"] == "clear"]
+    with profile_phase("queue_prune"):
+        for plan, _, error in run_sharded(
+            to_clear, lambda p: delete_command_queue(server_url, api_key, p["udid"]), max_workers,
+            udid_of=lambda p: p["udid"]
+        ):
+            if error:
+                plan["action"] = "error"
+                plan["error"] = str(error)
+
+    # 重新取得佇列長度，確認清理後的結果
+    cleared = [(p["udid"], p["serial"]) for p in to_clear]
+    after = {s["udid"]: s["depth"] for s in survey_command_queues(server_url, api_key, cleared, max_workers)[0]}
+    for plan in to_clear:
+        plan["after"] = after.get(plan["udid"], plan["after"])
+    return plans
+
+
+def print_prune_plan(plans, dry_run=True, top_n=50):
+    labels = {"clear": "清除", "partial": "部分符合（略過）", "keep": "不需處理", "error": "錯誤"}
+    counts = Counter(p["action"] for p in plans)
+    before_total = sum(p["before"] or 0 for p in plans)
+    after_total = sum(p["after"] or 0 for p in plans)
+
+    table = Table(title="🧹 佇列清理預覽" if dry_run else "🧹 佇列清理結果")
+    table.add_column("SerialNumber", style="green")
+    table.add_column("UDID", style="blue")
+    table.add_column("清理前", justify="right")
+    table.add_column("符合條件", justify="right", style="yellow")
+    table.add_column("清理後", justify="right")
+    table.add_column("動作", style="cyan")
+    table.add_column("命令類型")
+    shown = sorted((p for p in plans if p["action"] != "keep"), key=lambda p: -p["prunable"])
+    for plan in shown[:top_n]:
+        types = ", ".join(f"{name}×{count}" for name, count in plan["types"].most_common(3))
+        table.add_row(
+            plan["serial"], plan["udid"], str(plan["before"] if plan["before"] is not None else "-"),
+            str(plan["prunable"]), "-" if dry_run or plan["after"] is None else str(plan["after"]),
+            labels[plan["action"]], plan["error"] or types
+        )
+    console.print(table)
+    console.print(
+        f"清除 {counts['clear']} 台、部分符合 {counts['partial']} 台、不需處理 {counts['keep']} 台、"
+        f"錯誤 {counts['error']} 台；佇列總長度 {before_total}"
+        + ("" if dry_run else f" → {after_total}"),
+        style="bold green"
+    )
+    if counts["partial"]:
+        console.print("💡 部分符合的裝置仍有不符條件的命令，MicroMDM 無法只刪除單筆命令，因此保留不動", style="yellow")
+
+
 def push_device_with_mdmctl(udid):
-    result = subprocess.run(["mdmctl", "push", udid], capture_output=True, text=True)
-    if result.returncode == 0:
+    result = run_mdmctl(["push", udid])
+    if result is not None and result.returncode == 0:
         console.print(f"✅ mdmctl push 成功 ({udid})", style="green")
-    else:
-        console.print(f"❌ mdmctl push 失敗 ({udid}):", style="red")
+        return True
+    console.print(f"❌ mdmctl push 失敗 ({udid}):", style="red")
+    if result is not None:
         console.print(result.stderr)
+    return False
+
+
+def push_devices_with_mdmctl(udids):
+    """
+    並行以 mdmctl push 多台裝置（同時最多 MDMCTL_MAX_PROCS 個行程）。
+    mdmctl push 一次只接受一個 UDID，因此無法合併成單一次呼叫。
+    """
+    failed = []
+    for udid, ok, error in run_concurrently(udids, push_device_with_mdmctl, MDMCTL_MAX_PROCS):
+        if error or not ok:
+            failed.append(udid)
+    return failed
 
 
 def send_push_to_device(server_url, api_key, udid):
-    console.print(f"🔔 發送 Push 通知給裝置 {udid}...", style="bold blue")
-    auth = ('micromdm', api_key)
-    try:
-        resp = requests.get(f"{server_url}/push/{udid}", auth=auth)
-        console.print(resp.text)
-        if resp.status_code == 200:
-            console.print(f"✅ Push 通知回應 ({udid}): 200", style="green")
-        else:
+    """送出 Push，失敗時改用 mdmctl push；回傳是否成功（離線延後的裝置視為成功）"""
+    if udid in deferring_udids:
+        return True
+    with profile_phase("push"):
+        console.print(f"🔔 發送 Push 通知給裝置 {udid}...", style="bold blue")
+        try:
+            resp = mdm_request("GET", server_url, api_key, f"/push/{udid}", udid=udid)
+            console.print(resp.text)
+            if resp.status_code == 200:
+                console.print(f"✅ Push 通知回應 ({udid}): 200", style="green")
+                return True
             console.print(f"❌ Push 失敗，嘗試改用 mdmctl push", style="bold yellow")
-            push_device_with_mdmctl(udid)
-    except Exception as e:
-        console.print(f"⚠️ Push 發生錯誤：{str(e)}，改用 mdmctl push", style="bold yellow")
-        push_device_with_mdmctl(udid)
+        except Exception as e:
+            console.print(f"⚠️ Push 發生錯誤：{str(e)}，改用 mdmctl push", style="bold yellow")
+        return push_device_with_mdmctl(udid)
+
+
+def send_push_to_devices(server_url, api_key, udids):
+    """並行送出 Push，失敗的裝置再一起改用 mdmctl push；回傳仍失敗的 udid"""
+    def push(udid):
+        return mdm_request("GET", server_url, api_key, f"/push/{udid}", udid=udid, timeout=30).status_code
+
+    udids = [udid for udid in udids if udid not in deferring_udids]
+    fallback = []
+    with profile_phase("push"):
+        for udid, status, error in run_sharded(udids, push, udid_of=lambda udid: udid):
+            if error or status != 200:
+                fallback.append(udid)
+        console.print(f"🔔 Push 完成：成功 {len(udids) - len(fallback)} 台，失敗 {len(fallback)} 台", style="green")
+        if fallback:
+            console.print(f"❌ {len(fallback)} 台 Push 失敗，改用 mdmctl push", style="bold yellow")
+            return push_devices_with_mdmctl(fallback)
+    return []
+
+
+def dispatch_to_devices(devices, send, push=True, success=(201,)):
+    """
+    依裝置所屬伺服器並行執行 send(udid, serial)（回傳 HTTP 狀態），成功時 Push；
+    202 表示裝置離線、命令已延後。印出統計並回傳失敗的 [(udid, serial, 原因)]；
+    失敗（包含送出前的例外與 Push 失敗）同時寫入本次操作的結果檔與失敗清單。
+    """
+    def run(device):
+        status = send(*device)
+        if push and status == 201 and not send_push_to_device(MDM_URL, API_KEY, device[0]):
+            raise RuntimeError("命令已排入佇列，但 Push 失敗")
+        return status
+
+    failed = []
+    deferred = 0
+    sink = active_sink
+    for (udid, serial), status, error in run_sharded(devices, run):
+        if status == 202 and 202 not in success:
+            deferred += 1
+        elif error or status not in success:
+            failed.append((udid, serial, str(error or status)))
+            if sink:
+                sink.record_failure(udid, serial, str(error or status))
+    if deferred:
+        console.print(f"⏳ {deferred} 台裝置離線，命令已延後到下次上線", style="bold cyan")
+    if not failed:
+        console.print("✅ 作業完成！", style="bold green")
+    else:
+        console.print(f"❌ {len(failed)}/{len(devices)} 台作業失敗：", style="bold red")
+        for udid, serial, reason in failed:
+            console.print(f"  {serial} ({udid})：{reason}")
+    return failed
+
+
+def iter_param_rows(path):
+    """逐行讀取參數檔：.jsonl 每行一個物件，其他視為第一列是欄位名稱的 CSV；欄位名稱一律轉小寫"""
+    with open(path, newline='') as f:
+        if path.endswith(".jsonl"):
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    console.print(f"⚠️ 參數檔第 {number} 行不是有效的 JSON，略過", style="bold yellow")
+                    continue
+                yield {str(k).lower(): "" if v is None else str(v) for k, v in row.items()}
+        else:
+            for row in csv.DictReader(f):
+                yield {str(k).strip().lower(): (v or "").strip() for k, v in row.items() if k}
+
+
+def join_device_params(path, devices, stats):
+    """
+    以 udid 或序號（serial 欄位）把參數檔逐行對應到選擇的裝置，產出 ((udid, serial), 參數)。
+    參數檔不會整份載入；stats 累計總列數、找不到裝置與重複的列數，以及已對應的 udid。
+    """
+    by_udid = dict(devices)
+    udid_of_serial = {serial: udid for udid, serial in devices}
+    stats.update(rows=0, unmatched=0, duplicates=0, matched=set())
+    for row in iter_param_rows(path):
+        stats["rows"] += 1
+        udid = row.get("udid") or udid_of_serial.get(row.get("serial") or row.get("serial_number"))
+        if udid not in by_udid:
+            stats["unmatched"] += 1
+            continue
+        if udid in stats["matched"]:
+            stats["duplicates"] += 1
+            continue
+        stats["matched"].add(udid)
+        yield (udid, by_udid[udid]), row
+
+
+def dispatch_with_params(devices, path, send):
+    """
+    依參數檔對每台裝置送出不同內容的命令：send(udid, 參數) 回傳 HTTP 狀態，201 時 Push。
+    讀到一列就送進裝置所屬伺服器的執行緒池，不等整份檔案讀完。
+    """
+    def run(item):
+        (udid, _), params = item
+        status = send(udid, params)
+        if status == 201 and not send_push_to_device(MDM_URL, API_KEY, udid):
+            raise RuntimeError("命令已排入佇列，但 Push 失敗")
+        return status
+
+    stats = {}
+    succeeded = failed = 0
+    sink = active_sink
+    for ((udid, serial), _), status, error in run_sharded(join_device_params(path, devices, stats), run,
+                                                         udid_of=lambda item: item[0][0]):
+        if error or status not in (201, 202):
+            failed += 1
+            console.print(f"❌ {serial} ({udid})：{error or status}", style="bold red")
+            if sink:
+                sink.record_failure(udid, serial, str(error or status))
+        else:
+            succeeded += 1
+    console.print(f"📄 參數檔 {stats['rows']} 列：成功 {succeeded} 台、失敗 {failed} 台、"
+                  f"找不到裝置 {stats['unmatched']} 列、重複 {stats['duplicates']} 列", style="bold cyan")
+    missing = len(devices) - len(stats["matched"])
+    if missing:
+        console.print(f"⚠️ {missing} 台選擇的裝置在參數檔中沒有資料，未送出命令", style="bold yellow")
+    return failed == 0
+
+
+def ask_param_file(fields):
+    """詢問是否使用每台裝置各自的參數檔，回傳路徑或 None"""
+    if not Confirm.ask(f"是否使用參數檔（CSV / JSONL，以 udid 或 serial 對應，欄位：{', '.join(fields)}）?",
+                       default=False):
+        return None
+    path = Prompt.ask("📄 請輸入參數檔路徑")
+    if not os.path.exists(path):
+        console.print(f"❌ 找不到參數檔 {path}", style="bold red")
+        return None
+    return path
 
 
 def sync_dep_devices(server_url, api_key):
     console.print(f"🔄 同步 DEP 裝置...", style="bold blue")
-    auth = ('micromdm', api_key)
-    resp = requests.post(f"{server_url}/v1/dep/syncnow", auth=auth)
+    resp = mdm_request("POST", server_url, api_key, "/v1/dep/syncnow", timeout=30)
     console.print(f"✅ 回應: {resp.status_code}", style="green")
     console.print(resp.text)
     return resp.status_code
 
 
+def fetch_devices(server_url, api_key):
+    """取得 MicroMDM 上所有裝置的完整資料"""
+    resp = mdm_request(
+        "POST", server_url, api_key, "/v1/devices",
+        headers={"Content-Type": "application/json"},
+        data=json.dumps({})
+    )
+    resp.raise_for_status()
+    return resp.json().get("devices") or []
+
+
+def device_hash(device):
+    stable = {k: v for k, v in device.items() if k not in SNAPSHOT_IGNORE_FIELDS}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def diff_snapshot(previous, devices):
+    """比對快照，回傳 (新的快照, 新增裝置, 變動裝置, 移除的 udid)"""
+    current = {}
+    added, changed = [], []
+    for device in devices:
+        udid = device.get("udid")
+        if not udid:
+            continue
+        digest = device_hash(device)
+        current[udid] = digest
+        if udid not in previous:
+            added.append(device)
+        elif previous[udid] != digest:
+            changed.append(device)
+    removed = [udid for udid in previous if udid not in current]
+    return current, added, changed, removed
+
+
+device_snapshot = PersistentStore(DEVICE_SNAPSHOT_PATH)
+
+
+def parse_onboarding_commands(spec):
+    """把 DEP_ONBOARDING_COMMANDS 轉成 [(名稱, 函式)]"""
+    handlers = {
+        "DeviceInformation": get_device_info,
+        "InstalledApplicationList": get_installed_apps,
+        "SecurityInfo": get_security_info,
+        "DeviceConfigured": device_configured,
+    }
+    jobs = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, arg = item.partition("=")
+        if name == "InstallProfile" and arg:
+            jobs.append((item, lambda url, key, udid, path=arg: install_profile(url, key, udid, path)))
+        elif name in handlers:
+            jobs.append((name, handlers[name]))
+        else:
+            console.print(f"⚠️ 不支援的上線命令：{item}", style="bold yellow")
+    return jobs
+
+
+def fetch_all_devices():
+    """
+    並行向所有 MicroMDM 取得完整裝置資料並記錄所屬伺服器；
+    任一台失敗時回傳 None，避免把該伺服器的裝置誤判為已移除。
+    """
+    servers = get_mdm_servers()
+    merged = []
+    failed = False
+    for server, devices, error in run_concurrently(
+        servers, lambda server: fetch_devices(server.url, server.api_key), len(servers) or 1
+    ):
+        if error:
+            console.print(f"❌ {server.name} 取得裝置失敗：{error}", style="bold red")
+            failed = True
+            continue
+        for device in devices:
+            if device.get("udid"):
+                device_homes[device["udid"]] = server.name
+        merged.extend(devices)
+    return None if failed else merged
+
+
+def run_onboarding(devices, jobs):
+    """新裝置依所屬伺服器並行執行上線命令（命令會依 device_homes 送到該伺服器）"""
+    def onboard(device):
+        udid = device.get("udid")
+        results = [(name, job(MDM_URL, API_KEY, udid)) for name, job in jobs]
+        send_push_to_device(MDM_URL, API_KEY, udid)
+        return results
+
+    for device, results, error in run_sharded(devices, onboard, udid_of=lambda device: device.get("udid")):
+        serial = device.get("serial_number", "")
+        if error:
+            console.print(f"❌ 上線作業失敗 {serial}：{error}", style="bold red")
+        else:
+            summary = ", ".join(f"{name}={status}" for name, status in results)
+            console.print(f"🚀 已執行上線作業 {serial}：{summary}", style="green")
+
+
+def watch_dep_sync(interval=15, duration=600, jobs=None):
+    """對所有 MicroMDM 觸發 DEP 同步後定期比對裝置快照，只列出新增或變動的裝置"""
+    device_snapshot.ensure_loaded()
+    previous = dict(device_snapshot.data)
+    if not previous:
+        # 第一次執行：先建立基準快照，之後出現的才算新裝置
+        devices = fetch_all_devices()
+        if devices is None:
+            console.print("❌ 無法建立基準快照", style="bold red")
+            return Counter()
+        previous, _, _, _ = diff_snapshot({}, devices)
+        console.print(f"📸 已建立基準快照（{len(previous)} 台）", style="cyan")
+
+    for server in get_mdm_servers():
+        try:
+            sync_dep_devices(server.url, server.api_key)
+        except Exception as e:
+            console.print(f"❌ {server.name} 觸發 DEP 同步失敗：{e}", style="bold red")
+    deadline = time.time() + duration
+    totals = Counter()
+    try:
+        while True:
+            with profile_phase("device_fetch"):
+                devices = fetch_all_devices()
+            if devices is None:
+                console.print("⚠️ 本輪略過比對（有伺服器取得失敗）", style="yellow")
+                if time.time() + interval > deadline:
+                    break
+                time.sleep(interval)
+                continue
+            previous, added, changed, removed = diff_snapshot(previous, devices)
+            with device_snapshot.lock:
+                device_snapshot.data = previous
+                device_snapshot.dirty = True
+            for device in added:
+                console.print(f"🆕 新裝置 {device.get('serial_number', '')} ({device.get('udid')}) "
+                              f"{device.get('model', '')}", style="bold green")
+            for device in changed:
+                console.print(f"✏️ 裝置變動 {device.get('serial_number', '')} ({device.get('udid')})", style="yellow")
+            for udid in removed:
+                console.print(f"➖ 裝置已移除 {udid}", style="red")
+            totals.update(added=len(added), changed=len(changed), removed=len(removed))
+            if added and jobs:
+                run_onboarding(added, jobs)
+
+            if time.time() + interval > deadline:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        console.print("⏹️ 已停止監看", style="bold yellow")
+    finally:
+        device_snapshot.save()
+    console.print(f"📋 監看結束：新增 {totals['added']}、變動 {totals['changed']}、移除 {totals['removed']}",
+                  style="bold green")
+    return totals
+
+
 def parse_app_id(input_str):
     if input_str.startswith("http"):
         return input_str.split("id")[-1].split("?")[0]
     return input_str.strip()
 
 
+def lookup_app(app_id):
+    """以 iTunes Lookup API 取得 App 的 bundle id 與目前版本，失敗回傳 None"""
+    try:
+        resp = requests.get(ITUNES_LOOKUP_URL, params={"id": app_id}, timeout=10)
+        results = resp.json().get("results", [])
+    except Exception as e:
+        console.print(f"⚠️ 無法查詢 App 資訊：{e}", style="bold yellow")
+        return None
+    if not results:
+        return None
+    return {"bundle_id": results[0].get("bundleId"), "version": results[0].get("version"),
+            "name": results[0].get("trackName", "")}
+
+
 def enable_lost_mode(server_url, api_key, udid, message=None, phone_number=None, footnote=None):
     """啟用遺失模式"""
     console.print(f"🔍 啟用遺失模式 {udid}...", style="bold red")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "EnableLostMode"
@@ -586,7 +3395,7 @@ def enable_lost_mode(server_url, api_key, udid, message=None, phone_number=None,
     if footnote:
         payload["footnote"] = footnote
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 遺失模式啟用回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -595,14 +3404,12 @@ def enable_lost_mode(server_url, api_key, udid, message=None, phone_number=None,
 def disable_lost_mode(server_url, api_key, udid):
     """關閉遺失模式"""
     console.print(f"🔓 關閉遺失模式 {udid}...", style="bold green")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DisableLostMode"
     }
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 遺失模式關閉回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -611,14 +3418,12 @@ def disable_lost_mode(server_url, api_key, udid):
 def get_device_location(server_url, api_key, udid):
     """獲取設備位置（僅在遺失模式下可用）"""
     console.print(f"📍 獲取設備位置 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DeviceLocation"
     }
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 設備定位回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
 
@@ -643,14 +3448,12 @@ def get_device_location(server_url, api_key, udid):
 def play_lost_mode_sound(server_url, api_key, udid):
     """播放遺失模式聲音（僅在遺失模式下可用）"""
     console.print(f"🔊 播放遺失模式聲音 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "PlayLostModeSound"
     }
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 播放聲音回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -658,29 +3461,28 @@ def play_lost_mode_sound(server_url, api_key, udid):
 
 def wait_device_info(server_url, api_key, udid, max_retry=5, sleep_time=4):
     headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     data = json.dumps({})
-    for i in range(max_retry):
-        resp_info = requests.get(f"{server_url}/v1/devices/{udid}", headers=headers, auth=auth,data=data)
-        if resp_info.status_code == 200:
-            return resp_info.json()
-        else:
-            console.print(f"第{i+1}次查詢... 目前無資料，{resp_info.status_code}", style="yellow")
-            time.sleep(sleep_time)
+    with profile_phase("wait"):
+        for i in range(max_retry):
+            resp_info = mdm_request("GET", server_url, api_key, f"/v1/devices/{udid}", udid=udid, headers=headers,
+                                    data=data)
+            if resp_info.status_code == 200:
+                return resp_info.json()
+            else:
+                console.print(f"第{i+1}次查詢... 目前無資料，{resp_info.status_code}", style="yellow")
+                time.sleep(sleep_time)
     return None
 
 
 def check_lost_mode_status(server_url, api_key, udid):
     """檢查設備是否在遺失模式"""
     console.print(f"🔍 檢查遺失模式狀態 {udid}...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "SecurityInfo"
     }
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 安全資訊查詢回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
     return resp.status_code
@@ -700,14 +3502,12 @@ def get_device_location_with_check(server_url, api_key, udid):
 
     # 無論如何都嘗試獲取位置
     console.print(f"📍 嘗試獲取設備位置...", style="bold blue")
-    headers = {"Content-Type": "application/json"}
-    auth = ('micromdm', api_key)
     payload = {
         "udid": udid,
         "request_type": "DeviceLocation"
     }
 
-    resp = requests.post(f"{server_url}/v1/commands", headers=headers, auth=auth, data=json.dumps(payload))
+    resp = post_command(server_url, api_key, payload)
     console.print(f"✅ 設備定位回應 ({udid}):", resp.status_code, style="green")
     console.print(resp.text)
 
@@ -775,31 +3575,91 @@ def enhanced_on_mdm_event(data):
 
 
 def select_devices():
-    # 先嘗試線上取得裝置
-    status_code = get_device_from_net(MDM_URL, API_KEY, DEVICE_LIST_CSV)
-    if status_code != 200:
-        # 線上失敗則用本地方式
-        console.print("⚠️ 線上取得裝置失敗，改用本地 mdmctl！", style="bold yellow")
-        run_mdmctl_get_devices(DEVICE_LIST_CSV)
+    with profile_phase("device_fetch"):
+        # 先嘗試線上取得裝置
+        if get_inventory(DEVICE_LIST_CSV) is None:
+            # 線上失敗則用本地方式
+            console.print("⚠️ 線上取得裝置失敗，改用本地 mdmctl！", style="bold yellow")
+            run_mdmctl_get_devices(DEVICE_LIST_CSV)
 
     devices = []
-    with open(DEVICE_LIST_CSV, newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            if len(row) >= 2:
-                udid, serial = row[0].strip(), row[1].strip()
-                if udid and serial:
-                    devices.append((udid, serial))
+    for udid, serial, home in read_device_list(DEVICE_LIST_CSV):
+        devices.append((udid, serial))
+        device_serials[udid] = serial
+        if home:
+            device_homes[udid] = home
+
+    print_device_table(devices, "📋 裝置清單：")
+
+    return devices
+
 
-    table = Table(title="📋 裝置清單：")
+class DeviceIndex:
+    """裝置清單的搜尋索引：預先轉小寫，新的關鍵字以上一次關鍵字開頭時只在上次結果中縮小範圍"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.keys = [f"{serial}\t{udid}".lower() for udid, serial in devices]
+        self.last_query = ""
+        self.last_matches = range(len(devices))
+
+    def search(self, query, serial_only=False):
+        """回傳符合的索引（維持原順序）"""
+        query = query.strip().lower()
+        if not query:
+            return list(range(len(self.devices)))
+        candidates = self.last_matches if self.last_query and query.startswith(self.last_query) else \
+            range(len(self.devices))
+        matches = [i for i in candidates if query in self.keys[i]]
+        self.last_query, self.last_matches = query, matches
+        if serial_only:
+            return [i for i in matches if query in self.devices[i][1].lower()]
+        return matches
+
+
+def render_device_page(devices, rows, title, caption=None):
+    """只繪製指定的列；序號維持在完整清單中的位置，讓「自選裝置」可以直接輸入"""
+    table = Table(title=title, caption=caption)
     table.add_column("序號", justify="right", style="cyan")
     table.add_column("SerialNumber", style="green")
     table.add_column("UDID", style="blue")
-    for idx, (udid, serial) in enumerate(devices, 1):
-        table.add_row(str(idx), serial, udid)
+    for idx in rows:
+        udid, serial = devices[idx]
+        table.add_row(str(idx + 1), serial, udid)
     console.print(table)
 
-    return devices
+
+def browse_devices(devices, title, page_size=DEVICE_PAGE_SIZE):
+    """分頁瀏覽裝置清單，每次只繪製一頁；輸入 /關鍵字 搜尋，每次搜尋會在上次的結果中繼續縮小"""
+    index = DeviceIndex(devices)
+    matches = list(range(len(devices)))
+    query = ""
+    page = 0
+    while True:
+        pages = max(1, -(-len(matches) // page_size))
+        page = max(0, min(page, pages - 1))
+        caption = f"第 {page + 1}/{pages} 頁，共 {len(matches)} 台" + (f"（搜尋：{query}）" if query else "")
+        render_device_page(devices, matches[page * page_size:(page + 1) * page_size], title, caption)
+        command = Prompt.ask("n=下一頁, p=上一頁, 數字=跳頁, /關鍵字=搜尋, Enter=完成", default="").strip()
+        if not command:
+            return
+        if command == "n":
+            page += 1
+        elif command == "p":
+            page -= 1
+        elif command.isdigit():
+            page = int(command) - 1
+        elif command.startswith("/"):
+            query = command[1:].strip()
+            matches = index.search(query)
+            page = 0
+
+
+def print_device_table(devices, title):
+    if len(devices) <= DEVICE_PAGE_SIZE:
+        render_device_page(devices, range(len(devices)), title)
+    else:
+        browse_devices(devices, title)
 
 
 def select_devices_with_filter(filter_option=None):
@@ -807,11 +3667,11 @@ def select_devices_with_filter(filter_option=None):
 
     if not filter_option:
         filter_option = Prompt.ask(
-            "📦 請選擇操作方式 (1=全部, 2=選擇, 3=過濾)",
-            choices=["1", "2", "3"],
+            "📦 請選擇操作方式 (1=全部, 2=選擇, 3=過濾, 4=群組, 5=重試失敗清單)",
+            choices=["1", "2", "3", "4", "5"],
             default="1"
         )
-        console.print("1 = 所有裝置, 2 = 自選裝置（輸入序號）, 3 = 依序號過濾")
+        console.print("1 = 所有裝置, 2 = 自選裝置（輸入序號）, 3 = 依序號過濾, 4 = 依已儲存的群組, 5 = 上次失敗的裝置")
 
     if filter_option == "2":
         serial_input = Prompt.ask("請輸入要操作的序號（可用逗號分隔多筆）")
@@ -819,16 +3679,10 @@ def select_devices_with_filter(filter_option=None):
         devices = [d for idx, d in enumerate(devices, 1) if idx in selected]
     elif filter_option == "3":
         filter_serial = Prompt.ask("請輸入要過濾的序號關鍵字")
-        devices = [d for d in devices if filter_serial.lower() in d[1].lower()]
+        devices = [devices[i] for i in DeviceIndex(devices).search(filter_serial, serial_only=True)]
 
         # 顯示過濾後的結果
-        table = Table(title=f"📋 過濾後的裝置清單 (關鍵字: {filter_serial})：")
-        table.add_column("序號", justify="right", style="cyan")
-        table.add_column("SerialNumber", style="green")
-        table.add_column("UDID", style="blue")
-        for idx, (udid, serial) in enumerate(devices, 1):
-            table.add_row(str(idx), serial, udid)
-        console.print(table)
+        print_device_table(devices, f"📋 過濾後的裝置清單 (關鍵字: {filter_serial})：")
 
         if not devices:
             console.print("⚠️ 沒有符合條件的裝置。", style="bold yellow")
@@ -837,6 +3691,36 @@ def select_devices_with_filter(filter_option=None):
         confirm = Confirm.ask("要繼續操作這些裝置嗎?", default=True)
         if not confirm:
             return []
+    elif filter_option == "4":
+        names = device_groups.names()
+        if not names:
+            console.print("⚠️ 尚未建立任何群組（選單 36）", style="bold yellow")
+            return []
+        name = Prompt.ask("請選擇群組", choices=names)
+        devices = device_groups.resolve(name, devices)
+        print_device_table(devices, f"📋 群組 {name} 的裝置：")
+        if not devices:
+            console.print("⚠️ 群組內沒有符合條件的裝置。", style="bold yellow")
+            return []
+        if not Confirm.ask("要繼續操作這些裝置嗎?", default=True):
+            return []
+    elif filter_option == "5":
+        paths = list_failed_results()
+        if not paths:
+            console.print(f"⚠️ {RESULTS_DIR} 中沒有失敗清單", style="bold yellow")
+            return []
+        for idx, path in enumerate(paths[:10], 1):
+            console.print(f"{idx}. {os.path.basename(path)}")
+        picked = Prompt.ask("請選擇失敗清單", choices=[str(i) for i in range(1, min(len(paths), 10) + 1)],
+                            default="1")
+        failed = {udid for udid, _, _ in read_device_list(paths[int(picked) - 1])}
+        devices = [d for d in devices if d[0] in failed]
+        print_device_table(devices, f"📋 重試清單 ({os.path.basename(paths[int(picked) - 1])})：")
+        if not devices:
+            console.print("⚠️ 清單中的裝置已不在裝置清單內。", style="bold yellow")
+            return []
+        if not Confirm.ask("要繼續操作這些裝置嗎?", default=True):
+            return []
 
     return devices
 
@@ -876,6 +3760,14 @@ def show_menu():
         ("28", "📍 獲取設備位置（遺失模式）"),
         ("29", "🔊 播放遺失模式聲音"),
         ("30", "🔍 檢查遺失模式狀態"),
+        ("31", "📊 命令佇列總覽（並行統計）"),
+        ("32", "🧹 依條件清理命令佇列"),
+        ("33", "🗺️ 查詢歷史位置"),
+        ("34", "🌊 分批系統更新（canary + 分批）"),
+        ("35", "👀 DEP 同步監看（只顯示新增 / 變動裝置）"),
+        ("36", "🗂️ 管理裝置群組（靜態 / 條件式）"),
+        ("37", "📈 命令回應延遲統計"),
+        ("38", "🗃️ 查詢事件紀錄（webhook 保存的 event）"),
         ("0", "退出")
     ]
 
@@ -888,437 +3780,594 @@ def show_menu():
     return choice
 
 
-def main():
-    while True:
-        socketio_thread = start_socketio_client()
+def apply_presence_policy(devices):
+    """離線太久的裝置可照常送出、略過，或延後到下次 check-in 自動送出"""
+    online, offline = partition_by_presence(devices)
+    if not offline:
+        return devices
+    console.print(f"📴 {len(offline)} 台裝置超過 {OFFLINE_AFTER_HOURS:g} 小時沒有上線", style="bold yellow")
+    policy = Prompt.ask("離線裝置處理方式 (1=照常送出, 2=略過, 3=延後到下次上線自動送出)",
+                        choices=["1", "2", "3"], default="1")
+    if policy == "2":
+        return online
+    if policy == "3":
+        deferring_udids.update(udid for udid, _ in offline)
+    return devices
 
-        choice = show_menu()
-        global response, devices
-        if choice == "0":
-            console.print("👋 程式結束", style="bold green")
-            break
 
-        # 大部分選項需要選擇裝置
-        if choice in [
-            "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19",
-            "20", "21", "22", "23", "26", "27", "28", "29", "30"
-        ]:
+def run_action(choice):
+    """執行單一選單功能，回傳 False 表示已取消、不需詢問是否繼續"""
+    # 大部分選項需要選擇裝置
+    if choice in [
+        "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19",
+        "20", "21", "22", "23", "24", "26", "27", "28", "29", "30", "31", "32", "33"
+    ]:
+        with profile_phase("selection"):
             devices = select_devices_with_filter()
+        if not devices:
+            console.print("⚠️ 沒有符合條件的裝置，返回主選單", style="bold yellow")
+            return False
+        if choice in EVENT_ACTIONS:
+            subscribe_events(udids=[udid for udid, _ in devices])
+        if choice in OFFLINE_AWARE_ACTIONS:
+            devices = apply_presence_policy(devices)
             if not devices:
-                console.print("⚠️ 沒有符合條件的裝置，返回主選單", style="bold yellow")
-                continue
-
-        # VPP App 安裝
-        if choice == "1":
-            app_input = Prompt.ask("📱 請輸入 App 的 URL 或 ID")
-            app_id = parse_app_id(app_input)
-            sToken = load_sToken(VPPTOKEN_PATH)
-            for udid, serial in devices:
+                console.print("⚠️ 沒有在線的裝置，返回主選單", style="bold yellow")
+                return False
+
+    # VPP App 安裝
+    if choice == "1":
+        app_input = Prompt.ask("📱 請輸入 App 的 URL 或 ID")
+        app_id = parse_app_id(app_input)
+        app_info = lookup_app(app_id) or {}
+        bundle_id = app_info.get("bundle_id") or Prompt.ask(
+            "請輸入 App 的 Bundle ID（用來略過已安裝的裝置，留空則全部部署）", default="")
+        if bundle_id and not Confirm.ask("是否忽略已安裝清單、全部部署?", default=False):
+            plan = installed_apps.plan_deployment(devices, bundle_id, app_info.get("version"))
+            console.print(
+                f"📋 {app_info.get('name') or bundle_id} {app_info.get('version') or ''}："
+                f"已是最新 {len(plan['up_to_date'])} 台、版本較舊 {len(plan['outdated'])} 台、"
+                f"未安裝 {len(plan['missing'])} 台、無清單資料 {len(plan['unknown'])} 台",
+                style="bold cyan"
+            )
+            devices = plan["outdated"] + plan["missing"] + plan["unknown"]
+            if not devices:
+                console.print("✅ 所有裝置都已安裝目前版本，不需部署", style="bold green")
+                return True
+        sToken = load_sToken(VPPTOKEN_PATH)
+        synced = vpp_licenses.sync(sToken, app_id)
+        if synced is not None:
+            console.print(f"🔑 已同步 VPP 授權帳本（{synced} 筆變動）", style="bold cyan")
+        licensed = {serial for _, serial in devices if vpp_licenses.is_licensed(app_id, serial)}
+        if licensed:
+            console.print(f"🔑 {len(licensed)} 台裝置已持有授權，略過分配", style="bold cyan")
+
+        def deploy(udid, serial):
+            if serial not in licensed:
                 assign_vpp_license(sToken, app_id, serial)
-                response = install_app_to_device(MDM_URL, API_KEY, udid, app_id)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 企業內部 App 安裝
-        elif choice == "2":
-            identifier = Prompt.ask("請輸入要安裝的 App 識別碼（Bundle ID）")
-            for udid, _ in devices:
-                response = install_enterprise_app(MDM_URL, API_KEY, udid, identifier)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 鎖定裝置
-        elif choice == "3":
-            pin = Prompt.ask("🔐 請輸入鎖定 PIN（留空則不設定密碼）", default="")
-            for udid, _ in devices:
-                response = lock_device(MDM_URL, API_KEY, udid, pin if pin else None)
-                if response == 201:
-                    send_push_to_device(MDM_URL, API_KEY, udid)
-                    info = wait_device_info(MDM_URL, API_KEY, udid, max_retry=20, sleep_time=10)
-                    if info:
-                        console.print(f"✅ 裝置資訊 ({udid}):", style="bold green")
-                        console.print(json.dumps(info, ensure_ascii=False, indent=2))
-                    else:
-                        console.print(f"❌ 查詢裝置資訊失敗（裝置未即時回報，請稍後再試）", style="bold red")
-                else:
-                    console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                    console.print(response)
-
-        # 傳送訊息（透過鎖定顯示）
-        elif choice == "4":
-            message = Prompt.ask("📩 請輸入要顯示的訊息內容")
-            pin = Prompt.ask("🔐 請輸入鎖定 PIN（留空則不設定密碼）", default="")
-            for udid, _ in devices:
-                response = lock_device(MDM_URL, API_KEY, udid, pin if pin else None, message)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 重開機
-        elif choice == "5":
-            for udid, _ in devices:
-                response = restart_device(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response.status_code == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response.status_code)
-                console.print(response.text)
-
-        # 關機
-        elif choice == "6":
-            for udid, _ in devices:
-                response = shutdown_device(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response.status_code == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response.status_code)
-                console.print(response.text)
-
-        # 清除密碼
-        elif choice == "7":
-            for udid, _ in devices:
-                response = clear_passcode(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 移除應用程式
-        elif choice == "8":
-            remove_all = Confirm.ask("是否移除所有應用程式？", default=False)
-            if remove_all:
-                identifier = "*"
-            else:
-                identifier = Prompt.ask("請輸入要移除的應用程式識別碼 (Bundle ID)")
-            for udid, _ in devices:
-                response = remove_application(MDM_URL, API_KEY, udid, identifier)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 擦除裝置
-        elif choice == "9":
-            confirm = Confirm.ask("⚠️ 警告：此操作將抹除所有裝置數據！確定要繼續嗎？", default=False)
-            if not confirm:
-                console.print("已取消操作", style="bold yellow")
-                continue
-            pin = Prompt.ask("🔐 請輸入解鎖 PIN（留空則不設定）", default="")
-            for udid, _ in devices:
-                response = erase_device(MDM_URL, API_KEY, udid, pin if pin else None)
-                send_push_to_device(MDM_URL, API_KEY, udid)
+            return install_app_to_device(MDM_URL, API_KEY, udid, app_id)
+
+        dispatch_to_devices(devices, deploy)
+
+    # 企業內部 App 安裝
+    elif choice == "2":
+        identifier = Prompt.ask("請輸入要安裝的 App 識別碼（Bundle ID）")
+        dispatch_to_devices(devices, lambda udid, _: install_enterprise_app(MDM_URL, API_KEY, udid, identifier))
+
+    # 鎖定裝置
+    elif choice == "3":
+        param_file = ask_param_file(["pin", "message"])
+        if param_file:
+            dispatch_with_params(devices, param_file, lambda udid, params: lock_device(
+                MDM_URL, API_KEY, udid, params.get("pin") or None, params.get("message") or None))
+            return True
+        pin = Prompt.ask("🔐 請輸入鎖定 PIN（留空則不設定密碼）", default="")
+
+        def lock(device):
+            udid = device[0]
+            response = lock_device(MDM_URL, API_KEY, udid, pin if pin else None)
             if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 查詢裝置資訊
-        elif choice == "10":
-            for udid, _ in devices:
-                response = get_device_info(MDM_URL, API_KEY, udid)
-                if response == 201:
-                    send_push_to_device(MDM_URL, API_KEY, udid)
+                if not send_push_to_device(MDM_URL, API_KEY, udid):
+                    raise RuntimeError("命令已排入佇列，但 Push 失敗")
+                info = wait_device_info(MDM_URL, API_KEY, udid, max_retry=20, sleep_time=10)
+                if info:
+                    console.print(f"✅ 裝置資訊 ({udid}):", style="bold green")
+                    console.print(json.dumps(info, ensure_ascii=False, indent=2))
                 else:
-                    console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                    console.print(response)
-
-        # 查詢已安裝 App 清單
-        elif choice == "11":
-            for udid, _ in devices:
-                response = get_installed_apps(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 查詢已安裝描述檔清單
-        elif choice == "12":
-            for udid, _ in devices:
-                response = get_profiles(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 查詢可用系統更新
-        elif choice == "13":
-            for udid, _ in devices:
-                response = get_os_updates(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 排程系統更新
-        elif choice == "14":
-            product_key = Prompt.ask("請輸入產品金鑰 (例如: 012-34567-A)")
-            product_version = Prompt.ask("請輸入版本號 (例如: 17.5.1)")
-            install_actions = {
-                "1": "InstallASAP",
-                "2": "DownloadOnly",
-                "3": "NotifyOnly",
-                "4": "InstallLater",
-                "5": "InstallForceRestart"
-            }
-            console.print("安裝動作選項:")
-            for key, val in install_actions.items():
-                console.print(f"{key}. {val}")
-            action_choice = Prompt.ask("請選擇安裝動作", choices=list(install_actions.keys()), default="1")
-            install_action = install_actions[action_choice]
-            for udid, _ in devices:
-                response = schedule_os_update(MDM_URL, API_KEY, udid, product_key, product_version, install_action)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
+                    console.print(f"❌ 查詢裝置資訊失敗（裝置未即時回報，請稍後再試）", style="bold red")
+            elif response == 202:
+                console.print(f"⏳ 裝置 {udid} 離線，鎖定命令已延後到下次上線", style="bold cyan")
             else:
                 console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
                 console.print(response)
 
-        # 安裝設定描述檔
-        elif choice == "15":
-            profiles = [f for f in os.listdir(PROFILES_DIR) if f.endswith('.mobileconfig')]
-            if not profiles:
-                console.print(f"⚠️ 在 {PROFILES_DIR} 目錄下沒有找到 .mobileconfig 檔案", style="bold yellow")
-                profile_path = Prompt.ask("請輸入描述檔的完整路徑")
-            else:
-                table = Table(title="📋 可用描述檔列表：")
-                table.add_column("序號", justify="right", style="cyan")
-                table.add_column("檔案名稱", style="green")
-                for idx, profile in enumerate(profiles, 1):
-                    table.add_row(str(idx), profile)
-                console.print(table)
-                profile_idx = int(Prompt.ask("請選擇描述檔序號", default="1"))
-                if 1 <= profile_idx <= len(profiles):
-                    profile_path = os.path.join(PROFILES_DIR, profiles[profile_idx - 1])
-                else:
-                    console.print("無效選擇", style="bold red")
-                    continue
-            for udid, _ in devices:
-                response = install_profile(MDM_URL, API_KEY, udid, profile_path)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+        for (udid, serial), _, error in run_sharded(devices, lock):
+            if error:
+                console.print(f"❌ {serial} ({udid})：{error}", style="bold red")
+                if active_sink:
+                    active_sink.record_failure(udid, serial, str(error))
+
+    # 傳送訊息（透過鎖定顯示）
+    elif choice == "4":
+        message = Prompt.ask("📩 請輸入要顯示的訊息內容")
+        pin = Prompt.ask("🔐 請輸入鎖定 PIN（留空則不設定密碼）", default="")
+        dispatch_to_devices(devices, lambda udid, _: lock_device(MDM_URL, API_KEY, udid, pin if pin else None, message))
+
+    # 重開機
+    elif choice == "5":
+        dispatch_to_devices(devices, lambda udid, _: restart_device(MDM_URL, API_KEY, udid).status_code)
+
+    # 關機
+    elif choice == "6":
+        dispatch_to_devices(devices, lambda udid, _: shutdown_device(MDM_URL, API_KEY, udid).status_code)
+
+    # 清除密碼
+    elif choice == "7":
+        dispatch_to_devices(devices, lambda udid, _: clear_passcode(MDM_URL, API_KEY, udid))
+
+    # 移除應用程式
+    elif choice == "8":
+        remove_all = Confirm.ask("是否移除所有應用程式？", default=False)
+        if remove_all:
+            identifier = "*"
+        else:
+            identifier = Prompt.ask("請輸入要移除的應用程式識別碼 (Bundle ID)")
+        dispatch_to_devices(devices, lambda udid, _: remove_application(MDM_URL, API_KEY, udid, identifier))
 
-        # 移除設定描述檔
-        elif choice == "16":
-            identifier = Prompt.ask("請輸入要移除的描述檔識別碼 (PayloadIdentifier)")
-            for udid, _ in devices:
-                response = remove_profile(MDM_URL, API_KEY, udid, identifier)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
+    # 擦除裝置
+    elif choice == "9":
+        confirm = Confirm.ask("⚠️ 警告：此操作將抹除所有裝置數據！確定要繼續嗎？", default=False)
+        if not confirm:
+            console.print("已取消操作", style="bold yellow")
+            return False
+        pin = Prompt.ask("🔐 請輸入解鎖 PIN（留空則不設定）", default="")
+        dispatch_to_devices(devices, lambda udid, _: erase_device(MDM_URL, API_KEY, udid, pin if pin else None))
+
+    # 查詢裝置資訊
+    elif choice == "10":
+        force = Confirm.ask("是否忽略快取、強制重新查詢?", default=False)
+        stale_fields = {udid: DEVICE_INFO_QUERIES if force else device_facts.stale_fields(udid, DEVICE_INFO_QUERIES)
+                        for udid, _ in devices}
+        cached = [d for d in devices if not stale_fields[d[0]]]
+        # 只查詢已過期的欄位
+        dispatch_to_devices([d for d in devices if stale_fields[d[0]]],
+                            lambda udid, _: get_device_info(MDM_URL, API_KEY, udid, stale_fields[udid]))
+        if cached:
+            print_cached_facts(cached, DEVICE_INFO_QUERIES)
+        console.print(f"📊 {len(cached)} 台使用快取，{len(devices) - len(cached)} 台已發送查詢命令", style="bold cyan")
+
+    # 查詢已安裝 App 清單
+    elif choice == "11":
+        dispatch_to_devices(devices, lambda udid, _: get_installed_apps(MDM_URL, API_KEY, udid))
+
+    # 查詢已安裝描述檔清單
+    elif choice == "12":
+        dispatch_to_devices(devices, lambda udid, _: get_profiles(MDM_URL, API_KEY, udid))
+
+    # 查詢可用系統更新
+    elif choice == "13":
+        dispatch_to_devices(devices, lambda udid, _: get_os_updates(MDM_URL, API_KEY, udid))
+
+    # 排程系統更新
+    elif choice == "14":
+        product_key = Prompt.ask("請輸入產品金鑰 (例如: 012-34567-A)")
+        product_version = Prompt.ask("請輸入版本號 (例如: 17.5.1)")
+        install_action = ask_install_action()
+        dispatch_to_devices(devices, lambda udid, _: schedule_os_update(MDM_URL, API_KEY, udid, product_key, product_version, install_action))
+
+    # 安裝設定描述檔
+    elif choice == "15":
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        profiles = [f for f in os.listdir(PROFILES_DIR) if f.endswith('.mobileconfig')]
+        if not profiles:
+            console.print(f"⚠️ 在 {PROFILES_DIR} 目錄下沒有找到 .mobileconfig 檔案", style="bold yellow")
+            profile_path = Prompt.ask("請輸入描述檔的完整路徑")
+        else:
+            table = Table(title="📋 可用描述檔列表：")
+            table.add_column("序號", justify="right", style="cyan")
+            table.add_column("檔案名稱", style="green")
+            for idx, profile in enumerate(profiles, 1):
+                table.add_row(str(idx), profile)
+            console.print(table)
+            profile_idx = int(Prompt.ask("請選擇描述檔序號", default="1"))
+            if 1 <= profile_idx <= len(profiles):
+                profile_path = os.path.join(PROFILES_DIR, profiles[profile_idx - 1])
             else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 設定裝置預設帳號
-        elif choice == "17":
-            fullname = Prompt.ask("請輸入顯示名稱 (例如: John Appleseed)")
-            username = Prompt.ask("請輸入使用者名稱 (例如: john)")
+                console.print("無效選擇", style="bold red")
+                return False
+        dispatch_to_devices(devices, lambda udid, _: install_profile(MDM_URL, API_KEY, udid, profile_path))
+
+    # 移除設定描述檔
+    elif choice == "16":
+        identifier = Prompt.ask("請輸入要移除的描述檔識別碼 (PayloadIdentifier)")
+        dispatch_to_devices(devices, lambda udid, _: remove_profile(MDM_URL, API_KEY, udid, identifier))
+
+    # 設定裝置預設帳號
+    elif choice == "17":
+        param_file = ask_param_file(["fullname", "username"])
+        if param_file:
             lock_info = Confirm.ask("是否鎖定帳號資訊防止變更?", default=True)
-            for udid, _ in devices:
-                response = setup_account(MDM_URL, API_KEY, udid, fullname, username, lock_info)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 標記裝置已完成設定
-        elif choice == "18":
-            for udid, _ in devices:
-                response = device_configured(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 獲取啟用鎖繞過碼
-        elif choice == "19":
-            for udid, _ in devices:
-                response = get_activation_lock_bypass(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 獲取安全資訊
-        elif choice == "20":
-            for udid, _ in devices:
-                response = get_security_info(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 獲取憑證清單
-        elif choice == "21":
-            for udid, _ in devices:
-                response = get_certificate_list(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
-
-        # 清除命令佇列
-        elif choice == "22":
-            confirm = Confirm.ask("⚠️ 確定要清除命令佇列嗎？這將移除所有待處理命令！", default=False)
-            if not confirm:
-                console.print("已取消操作", style="bold yellow")
-                continue
-            for udid, _ in devices:
-                response = clear_command_queue(MDM_URL, API_KEY, udid)
-            if response == 200:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
 
-        # 檢查命令佇列
-        elif choice == "23":
-            for udid, _ in devices:
-                response = inspect_command_queue(MDM_URL, API_KEY, udid)
-            if response == 200:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+            def send(udid, params):
+                if not params.get("fullname") or not params.get("username"):
+                    raise ValueError("參數檔缺少 fullname 或 username")
+                return setup_account(MDM_URL, API_KEY, udid, params["fullname"], params["username"], lock_info)
+
+            dispatch_with_params(devices, param_file, send)
+            return True
+        fullname = Prompt.ask("請輸入顯示名稱 (例如: John Appleseed)")
+        username = Prompt.ask("請輸入使用者名稱 (例如: john)")
+        lock_info = Confirm.ask("是否鎖定帳號資訊防止變更?", default=True)
+        dispatch_to_devices(devices, lambda udid, _: setup_account(MDM_URL, API_KEY, udid, fullname, username, lock_info))
+
+    # 標記裝置已完成設定
+    elif choice == "18":
+        dispatch_to_devices(devices, lambda udid, _: device_configured(MDM_URL, API_KEY, udid))
+
+    # 獲取啟用鎖繞過碼
+    elif choice == "19":
+        dispatch_to_devices(devices, lambda udid, _: get_activation_lock_bypass(MDM_URL, API_KEY, udid))
+
+    # 獲取安全資訊
+    elif choice == "20":
+        force = Confirm.ask("是否忽略快取、強制重新查詢?", default=False)
+        stale = devices if force else [d for d in devices if device_facts.stale_fields(d[0], ["SecurityInfo"])]
+        cached = [d for d in devices if d not in stale]
+        if cached:
+            for udid, serial in cached:
+                console.print(f"🔐 安全資訊（快取）{serial} ({udid}):", style="bold green")
+                console.print(json.dumps(device_facts.get(udid, ["SecurityInfo"])["SecurityInfo"],
+                                         ensure_ascii=False, indent=2))
+        dispatch_to_devices(stale, lambda udid, _: get_security_info(MDM_URL, API_KEY, udid))
+        console.print(f"🔐 {len(cached)} 台使用快取，{len(stale)} 台已發送查詢命令", style="bold cyan")
+
+    # 獲取憑證清單
+    elif choice == "21":
+        dispatch_to_devices(devices, lambda udid, _: get_certificate_list(MDM_URL, API_KEY, udid))
+
+    # 清除命令佇列
+    elif choice == "22":
+        confirm = Confirm.ask("⚠️ 確定要清除命令佇列嗎？這將移除所有待處理命令！", default=False)
+        if not confirm:
+            console.print("已取消操作", style="bold yellow")
+            return False
+        dispatch_to_devices(devices, lambda udid, _: clear_command_queue(MDM_URL, API_KEY, udid), push=False, success=(200,))
+
+    # 檢查命令佇列
+    elif choice == "23":
+        dispatch_to_devices(devices, lambda udid, _: inspect_command_queue(MDM_URL, API_KEY, udid), push=False, success=(200,))
+
+    # 發送 Push 通知
+    elif choice == "24":
+        failed = set(send_push_to_devices(MDM_URL, API_KEY, [udid for udid, _ in devices]))
+        if not failed:
+            console.print("✅ 作業完成！", style="bold green")
+        else:
+            console.print(f"❌ {len(failed)} 台裝置 HTTP 與 mdmctl push 都失敗：", style="bold red")
+            for udid, serial in devices:
+                if udid in failed:
+                    console.print(f"  {serial} ({udid})")
+
+    # 同步 DEP 裝置
+    elif choice == "25":
+        response = None
+        for server in get_mdm_servers():
+            response = sync_dep_devices(server.url, server.api_key)
+        if response == 200:
+            console.print("✅ 作業完成！", style="bold green")
+        else:
+            console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
+            console.print(response)
+
+    # 啟用遺失模式
+    elif choice == "26":
+        param_file = ask_param_file(["message", "phone_number", "footnote"])
+        if param_file:
+            dispatch_with_params(devices, param_file, lambda udid, params: enable_lost_mode(
+                MDM_URL, API_KEY, udid, params.get("message") or "此裝置已遺失，請聯絡管理員",
+                params.get("phone_number") or None, params.get("footnote") or None))
+            return True
+        message = Prompt.ask("📩 請輸入遺失模式顯示訊息", default="此裝置已遺失，請聯絡管理員")
+        phone_number = Prompt.ask("📞 請輸入聯絡電話（可選）", default="")
+        footnote = Prompt.ask("📝 請輸入備註（可選）", default="")
+
+        dispatch_to_devices(devices, lambda udid, _: enable_lost_mode(
+            MDM_URL, API_KEY, udid,
+            message,
+            phone_number if phone_number else None,
+            footnote if footnote else None
+        ))
+
+    # 關閉遺失模式
+    elif choice == "27":
+        confirm = Confirm.ask("⚠️ 確定要關閉遺失模式嗎？", default=False)
+        if not confirm:
+            console.print("已取消操作", style="bold yellow")
+            return False
 
-        # 發送 Push 通知
-        elif choice == "24":
-            for udid, _ in devices:
-                response = send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 200:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+        dispatch_to_devices(devices, lambda udid, _: disable_lost_mode(MDM_URL, API_KEY, udid))
 
-        # 同步 DEP 裝置
-        elif choice == "25":
-            response = sync_dep_devices(MDM_URL, API_KEY)
-            if response == 200:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+    # 獲取設備位置（遺失模式）
+    elif choice == "28":
+        console.print("⚠️ 注意：此功能僅在設備處於遺失模式時可用", style="bold yellow")
+        console.print("💡 建議：先使用選項 30 檢查遺失模式狀態", style="bold cyan")
+        confirm = Confirm.ask("確定要獲取設備位置嗎？", default=True)
+        if not confirm:
+            console.print("已取消操作", style="bold yellow")
+            return False
 
-        # 啟用遺失模式
-        elif choice == "26":
-            message = Prompt.ask("📩 請輸入遺失模式顯示訊息", default="此裝置已遺失，請聯絡管理員")
-            phone_number = Prompt.ask("📞 請輸入聯絡電話（可選）", default="")
-            footnote = Prompt.ask("📝 請輸入備註（可選）", default="")
-
-            for udid, _ in devices:
-                response = enable_lost_mode(
-                    MDM_URL, API_KEY, udid,
-                    message,
-                    phone_number if phone_number else None,
-                    footnote if footnote else None
-                )
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+        targets, not_lost, unknown = lost_mode_index.partition(devices)
+        console.print(
+            f"🔍 遺失模式中 {len(targets)} 台、未啟用 {len(not_lost)} 台（略過）、狀態未知 {len(unknown)} 台",
+            style="bold cyan"
+        )
+        if unknown and Confirm.ask(f"是否也對狀態未知的 {len(unknown)} 台裝置發送定位命令？", default=False):
+            targets = targets + unknown
+        if not targets:
+            console.print("⚠️ 沒有處於遺失模式的裝置，請先使用選項 30 檢查遺失模式狀態", style="bold yellow")
+            return True
+
+        def locate(device):
+            status = get_device_location(MDM_URL, API_KEY, device[0])
+            if status == 201 and not send_push_to_device(MDM_URL, API_KEY, device[0]):
+                raise RuntimeError("命令已排入佇列，但 Push 失敗")
+            return status
+
+        for (udid, serial), status, error in run_sharded(targets, locate):
+            if error or status not in (201, 202):
+                console.print(f"❌ 定位命令失敗 {serial} ({udid})：{error or status}", style="bold red")
+                if active_sink:
+                    active_sink.record_failure(udid, serial, str(error or status))
+
+        console.print("📡 命令已發送，請注意觀察 SocketIO 回應...", style="bold cyan")
+        console.print("💡 位置資訊將通過 webhook 回應顯示", style="bold blue")
+
+    # 播放遺失模式聲音
+    elif choice == "29":
+        console.print("⚠️ 注意：此功能僅在設備處於遺失模式時可用", style="bold yellow")
+        confirm = Confirm.ask("確定要播放遺失模式聲音嗎？", default=True)
+        if not confirm:
+            console.print("已取消操作", style="bold yellow")
+            return False
+
+        if not dispatch_to_devices(devices, lambda udid, _: play_lost_mode_sound(MDM_URL, API_KEY, udid)):
+            console.print("🔊 設備將播放遺失模式聲音", style="bold green")
+
+    # 檢查遺失模式狀態
+    elif choice == "30":
+        console.print("🔍 正在檢查設備遺失模式狀態...", style="bold blue")
+        dispatch_to_devices(devices, lambda udid, _: check_lost_mode_status(MDM_URL, API_KEY, udid))
+
+        console.print("📡 狀態查詢命令已發送，請等待設備回應...", style="bold cyan")
+        console.print("💡 遺失模式狀態將通過 SocketIO 回應顯示", style="bold blue")
+
+    # 命令佇列總覽
+    elif choice == "31":
+        top_n = int(Prompt.ask("要列出前幾名最塞的裝置？", default="20"))
+        summaries, failures = survey_command_queues(MDM_URL, API_KEY, devices)
+        print_queue_survey(summaries, failures, top_n)
+
+    # 依條件清理命令佇列
+    elif choice == "32":
+        hours = Prompt.ask("⏳ 清除超過幾小時的命令（留空則不限）", default="72")
+        types_input = Prompt.ask("📋 只清除這些命令類型（逗號分隔，留空則不限）", default="")
+        max_age = timedelta(hours=float(hours)) if hours.strip() else None
+        request_types = {t.strip() for t in types_input.split(",") if t.strip()} or None
+        if max_age is None and not request_types:
+            console.print("⚠️ 請至少指定一個條件（時間或命令類型）", style="bold yellow")
+            return False
+
+        plans = prune_command_queues(MDM_URL, API_KEY, devices, max_age, request_types, dry_run=True)
+        print_prune_plan(plans, dry_run=True)
+        if not any(p["action"] == "clear" for p in plans):
+            console.print("沒有可清除的佇列", style="bold yellow")
+            return True
+        if not Confirm.ask("⚠️ 確定要清除上列佇列嗎？", default=False):
+            console.print("已取消操作", style="bold yellow")
+            return False
+        plans = prune_command_queues(MDM_URL, API_KEY, devices, max_age, request_types, dry_run=False)
+        print_prune_plan(plans, dry_run=False)
+
+    # DEP 同步監看
+    elif choice == "35":
+        interval = int(Prompt.ask("每隔幾秒比對一次？", default="15"))
+        duration = int(Prompt.ask("監看多久（秒）？", default="600"))
+        jobs = parse_onboarding_commands(DEP_ONBOARDING_COMMANDS)
+        if jobs and not Confirm.ask(f"新裝置出現時自動執行：{', '.join(name for name, _ in jobs)}？", default=True):
+            jobs = None
+        console.print("👀 監看中，按 Ctrl+C 可提前結束", style="bold cyan")
+        watch_dep_sync(interval, duration, jobs)
+
+    # 分批系統更新
+    elif choice == "34":
+        if os_update_campaign.active():
+            os_update_campaign.print_summary()
+            if Confirm.ask("要繼續執行這個未完成的活動嗎？", default=True):
+                os_update_campaign.data["state"] = "running"
+                os_update_campaign.run(MDM_URL, API_KEY)
+                os_update_campaign.print_summary()
+                return True
+            if not Confirm.ask("⚠️ 要放棄舊活動並建立新的嗎？", default=False):
+                return False
+            os_update_campaign.data["state"] = "aborted"
+            os_update_campaign.dirty = True
+
+        with profile_phase("selection"):
+            devices = select_devices_with_filter()
+        if not devices:
+            console.print("⚠️ 沒有符合條件的裝置，返回主選單", style="bold yellow")
+            return False
+        product_key = Prompt.ask("請輸入產品金鑰 (例如: 012-34567-A)")
+        product_version = Prompt.ask("請輸入版本號 (例如: 17.5.1)")
+        install_action = ask_install_action()
+        priority = Prompt.ask("更新優先權", choices=["Low", "High"], default="Low")
+        canary_pct = float(Prompt.ask("Canary 比例 (%)", default="5"))
+        wave_size = int(Prompt.ask("每批裝置數", default="50"))
+        concurrency = int(Prompt.ask("同時送出命令的上限", default="10"))
+        pacing = int(Prompt.ask("每批之間的間隔秒數", default="60"))
+        threshold = float(Prompt.ask("進入下一批所需的成功比例 (0~1)", default="0.9"))
+        wave_timeout = int(Prompt.ask("每批等待 ack 的逾時秒數", default="1800"))
+
+        os_update_campaign.create(devices, product_key, product_version, install_action, priority, canary_pct,
+                                  wave_size, concurrency, pacing, threshold, wave_timeout)
+        os_update_campaign.print_summary()
+        if not os_update_campaign.data["waves"]:
+            console.print("✅ 所有裝置都不需要更新", style="bold green")
+            return True
+        if not Confirm.ask("確定要開始這個更新活動嗎？", default=True):
+            console.print("已保存活動，可稍後從本選項續跑", style="bold yellow")
+            return False
+        os_update_campaign.run(MDM_URL, API_KEY)
+        os_update_campaign.print_summary()
+
+    # 查詢歷史位置
+    elif choice == "33":
+        limit = int(Prompt.ask("每台裝置顯示最近幾筆？", default="5"))
+        history = location_log.history([udid for udid, _ in devices], limit)
+        table = Table(title="🗺️ 歷史位置")
+        table.add_column("SerialNumber", style="green")
+        table.add_column("收到時間", style="cyan")
+        table.add_column("緯度", justify="right")
+        table.add_column("經度", justify="right")
+        table.add_column("精確度(m)", justify="right")
+        for udid, serial in devices:
+            for record in reversed(history[udid]):
+                table.add_row(serial, record["received_at"], str(record["latitude"]), str(record["longitude"]),
+                              str(record["horizontal_accuracy"] or ""))
+        console.print(table)
 
-        # 關閉遺失模式
-        elif choice == "27":
-            confirm = Confirm.ask("⚠️ 確定要關閉遺失模式嗎？", default=False)
-            if not confirm:
-                console.print("已取消操作", style="bold yellow")
-                continue
+    # 命令回應延遲統計
+    elif choice == "37":
+        ack_latency.print_table()
+        export_metrics()
+        console.print(f"📁 已匯出至 {METRICS_PATH}", style="bold cyan")
+
+    # 查詢事件紀錄
+    elif choice == "38":
+        key = Prompt.ask("序號、UDID 或 command UUID").strip()
+        serials = {serial: udid for udid, serial, _ in read_device_list(DEVICE_LIST_CSV)}
+        udid = serials.get(key) or next((u for u, s in device_serials.items() if s == key), None)
+        command_uuid = None
+        # 不是已知的序號或 UDID、且符合 UUID 格式時視為 command UUID（不需要載入任何索引）
+        if udid is None and key not in serials.values() and key not in device_serials and COMMAND_UUID_RE.match(key):
+            command_uuid = key
+        elif udid is None:
+            udid = key
+        response = Prompt.ask("回應類型", choices=["全部"] + EVENT_RESPONSE_TYPES, default="全部")
+        limit = int(Prompt.ask("顯示最近幾筆？", default="5"))
+
+        started = time.perf_counter()
+        records = event_archive.query(udid=udid, command_uuid=command_uuid,
+                                      response=None if response == "全部" else response, limit=limit)
+        elapsed = time.perf_counter() - started
+        if not records:
+            console.print(f"⚠️ 找不到符合的事件（{elapsed * 1000:.1f} ms）", style="bold yellow")
+            return True
+
+        table = Table(title=f"🗃️ 事件紀錄（{elapsed * 1000:.1f} ms）")
+        table.add_column("收到時間", style="cyan")
+        table.add_column("種類")
+        table.add_column("回應類型", style="green")
+        table.add_column("狀態")
+        table.add_column("command UUID", style="dim")
+        table.add_column("內容")
+        for record in records:
+            event = record.get("event") or {}
+            kind, _, uuid, kind_response = classify_event(event)
+            body = event.get(kind) or {}
+            detail = ""
+            if kind_response == "DeviceLocation":
+                payload = decode_ack_payload(body) or {}
+                detail = f"{payload.get('Latitude')}, {payload.get('Longitude')}"
+            elif kind == "checkin_event":
+                detail = (decode_ack_payload(body) or {}).get("MessageType", "")
+            received = datetime.fromtimestamp(record.get("ts", 0)).strftime("%Y-%m-%d %H:%M:%S")
+            table.add_row(received, kind, kind_response, str(body.get("status", "")), uuid or "", detail)
+        console.print(table)
 
-            for udid, _ in devices:
-                response = disable_lost_mode(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+    # 管理裝置群組
+    elif choice == "36":
+        table = Table(title="🗂️ 裝置群組")
+        table.add_column("名稱", style="green")
+        table.add_column("類型", style="cyan")
+        table.add_column("內容")
+        for name in device_groups.names():
+            group = device_groups.data[name]
+            detail = group["query"] if group["type"] == "dynamic" else f"{len(group['members'])} 台"
+            table.add_row(name, group["type"], detail)
+        console.print(table)
 
-        # 獲取設備位置（遺失模式）
-        elif choice == "28":
-            console.print("⚠️ 注意：此功能僅在設備處於遺失模式時可用", style="bold yellow")
-            console.print("💡 建議：先使用選項 30 檢查遺失模式狀態", style="bold cyan")
-            confirm = Confirm.ask("確定要獲取設備位置嗎？", default=True)
-            if not confirm:
-                console.print("已取消操作", style="bold yellow")
-                continue
+        action = Prompt.ask("請選擇 (1=新增條件式群組, 2=以目前選擇建立靜態群組, 3=刪除群組, 0=返回)",
+                            choices=["0", "1", "2", "3"], default="0")
+        if action == "1":
+            console.print(
+                "欄位：os_version、model、serial、last_seen_days、app（bundle id）、lost_mode（true/false）\n"
+                "範例：model contains iPad and os_version < 17 and last_seen_days > 7",
+                style="cyan"
+            )
+            name = Prompt.ask("群組名稱")
+            query = Prompt.ask("條件")
+            try:
+                device_groups.save_dynamic(name, query)
+            except ValueError as e:
+                console.print(f"❌ {e}", style="bold red")
+                return True
+            console.print(f"✅ 已儲存群組 {name}", style="bold green")
+        elif action == "2":
+            devices = select_devices_with_filter()
+            if not devices:
+                return False
+            name = Prompt.ask("群組名稱")
+            device_groups.save_static(name, devices)
+            console.print(f"✅ 已儲存群組 {name}（{len(devices)} 台）", style="bold green")
+        elif action == "3":
+            names = device_groups.names()
+            if not names:
+                return True
+            name = Prompt.ask("要刪除的群組", choices=names)
+            if Confirm.ask(f"確定要刪除群組 {name} 嗎？", default=False):
+                device_groups.delete(name)
+        else:
+            return False
 
-            for udid, _ in devices:
-                response = get_device_location_with_check(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
+    return True
 
-            console.print("📡 命令已發送，請注意觀察 SocketIO 回應...", style="bold cyan")
-            console.print("💡 位置資訊將通過 webhook 回應顯示", style="bold blue")
 
-        # 播放遺失模式聲音
-        elif choice == "29":
-            console.print("⚠️ 注意：此功能僅在設備處於遺失模式時可用", style="bold yellow")
-            confirm = Confirm.ask("確定要播放遺失模式聲音嗎？", default=True)
-            if not confirm:
-                console.print("已取消操作", style="bold yellow")
-                continue
+def main(profile=False):
+    global profiler
+    if profile:
+        profiler = ActionProfiler(PROFILE_DIR, PROFILE_TOP_N)
+        console.print(f"⏱️ 效能分析模式已啟用，輸出目錄：{PROFILE_DIR}", style="bold magenta")
 
-            for udid, _ in devices:
-                response = play_lost_mode_sound(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
-            if response == 201:
-                console.print("✅ 作業完成！設備將播放遺失模式聲音", style="bold green")
-            else:
-                console.print("❌ 作業失敗，詳細內容如下：", style="bold red")
-                console.print(response)
+    while True:
+        choice = show_menu()
+        if choice == "0":
+            console.print("👋 程式結束", style="bold green")
+            break
 
-        # 檢查遺失模式狀態
-        elif choice == "30":
-            console.print("🔍 正在檢查設備遺失模式狀態...", style="bold blue")
-            for udid, _ in devices:
-                response = check_lost_mode_status(MDM_URL, API_KEY, udid)
-                send_push_to_device(MDM_URL, API_KEY, udid)
+        # 只有需要裝置回應的功能才啟動 Socket.IO 監聽
+        if choice in EVENT_ACTIONS:
+            # 訂閱條件由各功能在選擇裝置後設定，這裡先還原
+            subscribe_events(udids=(), request_types=(), command_uuids=())
+            start_socketio_client()
 
-            console.print("📡 狀態查詢命令已發送，請等待設備回應...", style="bold cyan")
-            console.print("💡 遺失模式狀態將通過 SocketIO 回應顯示", style="bold blue")
+        try:
+            with profile_action(f"option_{choice}"), result_sink(f"option_{choice}"):
+                should_ask = run_action(choice)
+        finally:
+            if choice in EVENT_ACTIONS:
+                # 功能結束後還原訂閱條件，之後才送出的延後命令 ack 不會被這次選擇的裝置過濾掉
+                subscribe_events(udids=(), request_types=(), command_uuids=())
+        if deferring_udids:
+            console.print(f"⏳ {len(deferring_udids)} 台離線裝置的命令已延後，上線時會自動送出", style="bold cyan")
+            deferring_udids.clear()
+            subscribe_events(checkin_udids=deferred_commands.udids())
+            start_socketio_client()
+        flush_stores()
+        if ack_latency.counts:
+            export_metrics()
+        if not should_ask:
+            continue
 
         # 詢問是否繼續
         if not Confirm.ask("是否繼續執行其他操作?", default=True):
@@ -1327,4 +4376,11 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="MicroMDM 管理工具")
+    parser.add_argument("--profile", action="store_true", help="以 cProfile/tracemalloc 分析每個選單功能")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="效能分析輸出目錄")
+    parser.add_argument("--profile-top", type=int, default=PROFILE_TOP_N, help="摘要列出的前 N 筆")
+    args = parser.parse_args()
+    PROFILE_DIR = args.profile_dir
+    PROFILE_TOP_N = args.profile_top
+    main(profile=args.profile)
@@ -1,16 +1,129 @@
-from flask import Flask, request
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import Flask, request, jsonify
 
 app = Flask(__name__)
 
+# MicroMDM 沒收到 200 會重送 webhook，同一個 event 在時間窗內只處理一次
+DEDUP_TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', '300'))
+DEDUP_MAX = int(os.getenv('WEBHOOK_DEDUP_MAX', '100000'))
+# event 以 JSONL 分段保存，main.py 會為每個分段建立索引查詢
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR', './event_logs')
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv('EVENT_LOG_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+
+
+class DedupCache:
+    """有時間窗與數量上限的去重快取；依收到順序保存，過期或超量時從最舊的開始移除"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.received = 0
+        self.duplicates = 0
+
+    def seen(self, key, now=None):
+        """回傳 True 表示時間窗內已收過這個 event"""
+        now = now or time.monotonic()
+        with self.lock:
+            self.received += 1
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if now - oldest <= self.ttl and len(self.entries) < self.max_size:
+                    break
+                self.entries.popitem(last=False)
+            if key in self.entries:
+                self.duplicates += 1
+                return True
+            self.entries[key] = now
+            return False
+
+    def forget(self, key):
+        """處理失敗時移除，讓 MicroMDM 重送的 event 能再處理一次"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "received": self.received,
+                "duplicates": self.duplicates,
+                "suppression_rate": self.duplicates / self.received if self.received else 0.0,
+                "cached_keys": len(self.entries),
+            }
+
+
+dedup = DedupCache(DEDUP_TTL, DEDUP_MAX)
+
+
+class EventLog:
+    """把 event 逐行追加到 JSONL 分段檔，超過大小就換新的分段（檔名依時間排序）"""
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.file = None
+
+    def open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = sorted(f for f in os.listdir(self.directory) if f.startswith("events-") and f.endswith(".jsonl"))
+        if segments and os.path.getsize(os.path.join(self.directory, segments[-1])) < self.segment_bytes:
+            name = segments[-1]
+        else:
+            name = datetime.now().strftime("events-%Y%m%d-%H%M%S-%f.jsonl")
+        self.file = open(os.path.join(self.directory, name), "a")
+
+    def append(self, data):
+        line = json.dumps({"ts": time.time(), "event": data}, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.segment_bytes:
+                if self.file is not None:
+                    self.file.close()
+                self.open_segment()
+            self.file.write(line)
+            self.file.flush()
+
+
+event_log = EventLog(EVENT_LOG_DIR, EVENT_LOG_SEGMENT_BYTES)
+
+
+def event_key(data, body):
+    """ack 以 udid + command UUID + 狀態識別，其他 event 以內容雜湊識別"""
+    ack = (data or {}).get("acknowledge_event") or {}
+    if ack.get("command_uuid"):
+        return f"ack:{ack.get('udid')}:{ack['command_uuid']}:{ack.get('status')}"
+    return "sha1:" + hashlib.sha1(body).hexdigest()
+
 
 @app.route('/webhook', methods=['POST'])
 def micromdm_webhook():
     # MicroMDM 會把 event 以 JSON 傳過來
     data = request.json
 
-    # 印出所有 event（你可以改成存到資料庫、寫檔案...）
+    # 重送的 event 直接回 200，不再往下處理
+    key = event_key(data, request.get_data())
+    if dedup.seen(key):
+        stats = dedup.stats()
+        print(f"略過重複 event（{stats['duplicates']}/{stats['received']}，{stats['suppression_rate']:.1%}）")
+        return '', 200
+
+    # 印出所有 event，並保存到 JSONL 分段檔
     print("收到 MicroMDM Webhook event：")
     print(data)
+    try:
+        event_log.append(data)
+    except Exception:
+        # 沒保存成功就不算收過，MicroMDM 重送時再處理
+        dedup.forget(key)
+        raise
 
     # 這邊可以根據 event 內容做判斷處理
     # 例如：if data.get("topic") == "mdm.Connect": ...
@@ -18,5 +131,10 @@ def micromdm_webhook():
     return '', 200  # 只要回 200 表示收到
 
 
+@app.route('/stats', methods=['GET'])
+def webhook_stats():
+    return jsonify(dedup.stats())
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5001)